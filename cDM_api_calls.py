@@ -1,76 +1,1020 @@
 #! /usr/bin/env python3
 
-import urllib.request
+import codecs
+import collections
+import gzip
+import hashlib
+import http.client
+import io
+import json
 import os
+import queue
+import random
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+import zlib
+
+import cDM_metrics
 
 # "alias" is contentDM's term for collection name
 # "pointer" is contentDM's term for item name
 
 
-url_prefix = 'https://server16313.contentdm.oclc.org/dmwebservices/index.php?q='
+# CDM_API_URL_PREFIX & CDM_BINARY_URL_PREFIX override the two servers, e.g. to point
+# the scraper at fake_cDM_server.py; configure_servers() does the same from python.
+url_prefix = os.environ.get('CDM_API_URL_PREFIX',
+                            'https://server16313.contentdm.oclc.org/dmwebservices/index.php?q=')
+binary_url_prefix = os.environ.get('CDM_BINARY_URL_PREFIX',
+                                   'https://cdm16313.contentdm.oclc.org/utils/getfile/collection')
+
+
+def configure_servers(api_url_prefix, binary_prefix):
+    global url_prefix, binary_url_prefix
+    url_prefix, binary_url_prefix = api_url_prefix, binary_prefix
+
+# Every call below goes through one pooled transport, which keeps connections open
+# per host (the dmwebservices host & the getfile host) instead of paying a new tcp
+# and tls handshake on every request.  POOL_SIZE caps how many idle connections are
+# kept per host; a connection left idle longer than IDLE_TIMEOUT seconds is closed
+# rather than reused, since the server will likely have dropped it by then.
+POOL_SIZE = 8
+IDLE_TIMEOUT = 30
+MAX_REDIRECTS = 5
+
+# Each host gets its own AdaptiveLimiter, which caps how many requests may be open
+# against it at once.  The cap grows additively while responses come back healthy
+# and is cut multiplicatively on 429/503, on connection errors & timeouts, or when
+# latency climbs well above what the host has shown it can do.
+INITIAL_CONCURRENCY = 4
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 64
+BACKOFF_FACTOR = 0.5
+LATENCY_TOLERANCE = 2.0
+DECREASE_COOLDOWN = 1.0
+CONGESTION_STATUSES = (429, 503)
+
+# When several processes scrape at once, they can share one cap on requests in flight
+# across all of them: configure_request_slots() takes a multiprocessing semaphore, and
+# every request holds one of its slots from sending until its response is closed.
+request_slots = None
+
+# Transient failures (connection errors, timeouts, 429 & 5xx) are retried with
+# exponential backoff and full jitter, up to RETRY_ATTEMPTS tries per endpoint.
+# Every retry also spends a token from one shared RetryBudget, which only earns
+# RETRY_BUDGET_RATIO tokens per request; once a broken server has used it up,
+# failures surface at once instead of multiplying the load.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_RETRY_ATTEMPTS = 4
+RETRY_ATTEMPTS = {'dmGetItemInfo': 5,
+                  'GetParent': 5,
+                  'dmGetCompoundObjectInfo': 5,
+                  'dmQuery': 5,
+                  'getfile': 3, }
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+RETRY_BUDGET_RATIO = 0.1
+RETRY_BUDGET_RESERVE = 10
+RETRY_BUDGET_MAX = 100
+
+# Each host also gets a CircuitBreaker, since the dmwebservices host & the getfile host
+# fail independently.  CIRCUIT_FAILURE_THRESHOLD failed attempts in a row open it, and
+# while it is open every request to that host fails at once with CircuitOpen instead
+# of sitting through timeouts & retries.  After CIRCUIT_RESET_TIMEOUT seconds a single
+# trial request is let through: success closes the breaker, failure opens it again.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 60
+
+# With hedging on, the tiny dmGetItemInfo & GetParent calls are hedged: if a request
+# has not answered within the endpoint's recent p95 latency, a duplicate goes out and
+# whichever answers first is used.  A hedge spends a token from hedge_budget, which
+# earns HEDGE_BUDGET_RATIO tokens per request, so hedges add at most that share of load.
+# No hedging happens until HEDGE_MIN_SAMPLES latencies have been seen for the endpoint.
+hedging = False
+HEDGED_ENDPOINTS = ('dmGetItemInfo', 'GetParent')
+HEDGE_QUANTILE = 0.95
+HEDGE_BUDGET_RATIO = 0.05
+HEDGE_BUDGET_RESERVE = 5
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 1000
+
+# Responses from the endpoints in CACHE_TTLS are kept on disk under cache_dir, keyed
+# by url.  A fresh entry is served without touching the network.  A stale entry is
+# revalidated with If-None-Match / If-Modified-Since when the server handed us an
+# ETag or Last-Modified, and simply refetched when it didn't.
+# Set cache_dir to None to turn the cache off.
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'cdm_xporter')
+CACHE_TTLS = {'dmGetCollectionList': 24 * 60 * 60,
+              'dmGetCollectionArchivalInfo': 24 * 60 * 60,
+              'dmGetCollectionFieldInfo': 24 * 60 * 60,
+              'dmQueryTotalRecs': 60 * 60, }
+
+# The xml & json endpoints are asked for gzip/deflate and decoded here; binaries are
+# left alone, since they are already compressed formats and get streamed to disk.
+# transfer_stats counts bytes off the wire vs bytes of text they decoded to.
+TEXT_ACCEPT_ENCODING = 'gzip, deflate'
+
+# binaries are copied from the socket to disk CHUNK_SIZE bytes at a time,
+# so a multi-gigabyte video never has to fit in memory.
+CHUNK_SIZE = 1024 * 1024
+
+# Deadlines in seconds, per endpoint class: 'binary' for getfile, 'api' for every
+# dmwebservices call.  'connect' bounds opening the tcp/tls connection, 'read' bounds
+# any one wait on the socket, and 'total' bounds a whole attempt, body included
+# (None for no limit -- a large video may take as long as it takes, so long as it moves).
+TIMEOUTS = {'api': {'connect': 10, 'read': 30, 'total': 120},
+            'binary': {'connect': 10, 'read': 60, 'total': None}, }
+
+# The download watchdog cancels a binary whose throughput over the last STALL_WINDOW
+# seconds fell under MIN_THROUGHPUT bytes per second.  The cancelled transfer is
+# retried like any other transient failure, picking up from its .part file.
+MIN_THROUGHPUT = 16 * 1024
+STALL_WINDOW = 60
+
+
+class ConnectionPool():
+    def __init__(self, pool_size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+    def get_connection(self, scheme, host):
+        # returns (connection, was_reused)
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            idle = self.idle.get((scheme, host), [])
+            while idle:
+                conn, released_at = idle.pop()
+                if now - released_at < self.idle_timeout:
+                    break
+                expired.append(conn)
+            else:
+                conn = None
+        for stale_conn in expired:
+            stale_conn.close()
+        if conn:
+            return conn, True
+        return new_connection(scheme, host), False
+
+    def put_connection(self, scheme, host, conn):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host), [])
+            if len(idle) < self.pool_size:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def close_all(self):
+        with self.lock:
+            idle_lists, self.idle = list(self.idle.values()), dict()
+        for idle in idle_lists:
+            for conn, _ in idle:
+                conn.close()
+
+
+class StalledTransfer(urllib.error.URLError):
+    pass
+
+
+class ThroughputWatchdog():
+    def __init__(self, url, min_throughput=MIN_THROUGHPUT, window=STALL_WINDOW):
+        self.url = url
+        self.min_throughput = min_throughput
+        self.window = window
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+
+    def update(self, nbytes):
+        # called after every chunk; raises StalledTransfer once a full window came in too slowly.
+        self.window_bytes += nbytes
+        elapsed = time.monotonic() - self.window_start
+        if elapsed < self.window:
+            return
+        throughput = self.window_bytes / elapsed
+        if throughput < self.min_throughput:
+            raise StalledTransfer('{} stalled at {:.0f} bytes/s'.format(self.url, throughput))
+        self.window_start, self.window_bytes = time.monotonic(), 0
+
+
+class CircuitOpen(urllib.error.URLError):
+    pass
+
+
+class CircuitBreaker():
+    def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half-open'
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def is_open(self):
+        with self.lock:
+            return self.state != 'closed'
+
+    def seconds_until_trial(self):
+        with self.lock:
+            if self.state != 'open':
+                return 0
+            return max(0, self.opened_at + self.reset_timeout - time.monotonic())
+
+
+class AdaptiveLimiter():
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.smoothed_latency = None
+        self.baseline_latency = None
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def try_acquire(self):
+        with self.condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, congested=False):
+        with self.condition:
+            was_saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if congested:
+                self.decrease()
+            elif latency is not None:
+                self.record_latency(latency, was_saturated)
+            self.condition.notify_all()
+
+    def record_latency(self, latency, was_saturated):
+        if self.smoothed_latency is None:
+            self.smoothed_latency = self.baseline_latency = latency
+        self.smoothed_latency = 0.8 * self.smoothed_latency + 0.2 * latency
+        # the baseline follows the best latency seen, but drifts up slowly,
+        # so a host that is permanently a bit slower is not punished forever.
+        self.baseline_latency = min(self.smoothed_latency,
+                                    self.baseline_latency + 0.01 * (self.smoothed_latency - self.baseline_latency))
+        if self.smoothed_latency > self.baseline_latency * LATENCY_TOLERANCE:
+            self.decrease()
+        elif was_saturated:
+            # +1 per window of `limit` healthy responses, only while the limit is actually in use.
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease < DECREASE_COOLDOWN:
+            return
+        self.last_decrease = now
+        self.limit = max(self.minimum, self.limit * BACKOFF_FACTOR)
+
+
+limiters = dict()
+limiters_lock = threading.Lock()
+
+
+def get_limiter(host):
+    with limiters_lock:
+        if host not in limiters:
+            limiters[host] = AdaptiveLimiter()
+        return limiters[host]
+
+
+breakers = dict()
+breakers_lock = threading.Lock()
+
+
+def get_breaker(host):
+    with breakers_lock:
+        if host not in breakers:
+            breakers[host] = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        return breakers[host]
+
+
+def host_of(url):
+    return urllib.parse.urlsplit(url).netloc
+
+
+def circuit_is_open(url):
+    return get_breaker(host_of(url)).is_open()
+
+
+def wait_for_circuit(url):
+    # sleeps until an open breaker lets its trial request through.
+    time.sleep(get_breaker(host_of(url)).seconds_until_trial())
+
+
+class RetryBudget():
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, reserve=RETRY_BUDGET_RESERVE, maximum=RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.tokens = float(reserve)
+        self.lock = threading.Lock()
+
+    def record_request(self):
+        with self.lock:
+            self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def try_spend(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+retry_budget = RetryBudget()
+hedge_budget = RetryBudget(HEDGE_BUDGET_RATIO, HEDGE_BUDGET_RESERVE)
+
+
+class LatencyTracker():
+    # the last LATENCY_WINDOW latencies per endpoint, for exact recent quantiles.
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.samples = dict()
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, latency):
+        with self.lock:
+            samples = self.samples.setdefault(endpoint, collections.deque(maxlen=self.window))
+            samples.append(latency)
+
+    def quantile(self, endpoint, quantile, min_samples=1):
+        with self.lock:
+            samples = sorted(self.samples.get(endpoint, ()))
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(quantile * len(samples)))]
+
+
+latency_tracker = LatencyTracker()
+
+transfer_stats = {'wire_bytes': 0, 'decoded_bytes': 0}
+transfer_stats_lock = threading.Lock()
+
+
+class PooledResponse():
+    # Wraps an http.client.HTTPResponse.  Once the body has been read through, closing
+    # it hands the connection back to the pool; a half-read connection is thrown away,
+    # since the unread bytes would corrupt the next response on that socket.  A body
+    # cut short by a timeout, a stall or a dropped connection counts as congestion.
+    def __init__(self, pool, scheme, host, conn, response, url, limiter=None, started=None, deadline=None, slots=None,
+                 read_timeout=None):
+        self.pool = pool
+        self.scheme = scheme
+        self.host = host
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.limiter = limiter
+        self.started = started or time.monotonic()
+        self.latency = time.monotonic() - self.started
+        self.received = 0
+        self.deadline = deadline
+        self.read_timeout = read_timeout
+        self.slots = slots
+        self.errored = False
+
+    def check_deadline(self):
+        # past the deadline, raises; short of it, no single wait on the socket may outlast it.
+        if self.deadline is None:
+            return
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('{} ran past its total deadline'.format(self.url))
+        if self.conn is not None and self.conn.sock is not None:
+            self.conn.sock.settimeout(min(self.read_timeout or remaining, remaining))
+
+    def read(self, amt=None):
+        try:
+            self.check_deadline()
+            data = self.response.read(amt)
+        except TRANSIENT_ERRORS:
+            self.errored = True
+            raise
+        self.received += len(data)
+        return data
+
+    def read1(self, amt=-1):
+        # whatever is already available, up to amt -- never waits for a full chunk to trickle in.
+        try:
+            self.check_deadline()
+            data = self.response.read1(amt)
+        except TRANSIENT_ERRORS:
+            self.errored = True
+            raise
+        self.received += len(data)
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.put_connection(self.scheme, self.host, self.conn)
+        else:
+            self.response.close()
+            self.conn.close()
+        self.conn = None
+        if self.limiter:
+            self.limiter.release(self.latency, congested=self.errored or self.status in CONGESTION_STATUSES)
+        if self.slots is not None:
+            self.slots.release()
+        cDM_metrics.metrics.observe(endpoint_of(self.url), alias_of(self.url),
+                        time.monotonic() - self.started, self.status, self.received)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # a StalledTransfer is raised by the caller's watchdog, not by a read.
+        if isinstance(exc, TRANSIENT_ERRORS):
+            self.errored = True
+        self.close()
+
+
+connection_pool = ConnectionPool()
+
+
+def reset_after_fork():
+    # A forked child must not share the parent's pooled sockets -- two processes reading
+    # one connection get each other's responses -- nor locks another thread may have held.
+    global connection_pool, limiters, limiters_lock, breakers, breakers_lock, transfer_stats_lock
+    connection_pool = ConnectionPool(connection_pool.pool_size, connection_pool.idle_timeout)
+    limiters, limiters_lock = dict(), threading.Lock()
+    breakers, breakers_lock = dict(), threading.Lock()
+    retry_budget.lock = threading.Lock()
+    hedge_budget.lock = threading.Lock()
+    latency_tracker.lock = threading.Lock()
+    transfer_stats_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def configure_request_slots(slots):
+    global request_slots
+    request_slots = slots
+
+
+def configure_connection_pool(pool_size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT):
+    global connection_pool
+    old_pool, connection_pool = connection_pool, ConnectionPool(pool_size, idle_timeout)
+    old_pool.close_all()
+
+
+def new_connection(scheme, host):
+    if scheme == 'https':
+        return http.client.HTTPSConnection(host, context=ssl.create_default_context())
+    return http.client.HTTPConnection(host)
+
+
+def endpoint_class(url):
+    return 'binary' if endpoint_of(url) == 'getfile' else 'api'
+
+
+def set_timeouts(conn, timeouts, deadline=None):
+    # the connect timeout applies while the socket opens; after that, each read gets
+    # `read`, or whatever is left before the deadline if that is less.
+    if conn.sock is None:
+        conn.timeout = timeouts['connect']
+        conn.connect()
+    read_timeout = timeouts['read']
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('ran past its total deadline while connecting')
+        read_timeout = min(read_timeout, remaining)
+    conn.sock.settimeout(read_timeout)
+
+
+def pooled_request(url, headers=None):
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path = '{}?{}'.format(path, parts.query)
+    request_headers = {'Connection': 'keep-alive'}
+    request_headers.update(headers or {})
+    pool = connection_pool
+    limiter = get_limiter(parts.netloc)
+    timeouts = TIMEOUTS[endpoint_class(url)]
+    limiter.acquire()
+    slots = request_slots
+    if slots is not None:
+        slots.acquire()
+    while True:
+        conn, reused = pool.get_connection(parts.scheme, parts.netloc)
+        started = time.monotonic()
+        deadline = started + timeouts['total'] if timeouts['total'] is not None else None
+        try:
+            set_timeouts(conn, timeouts, deadline)
+            conn.request('GET', path, headers=request_headers)
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            if reused:
+                # the server may have dropped an idle keep-alive connection.
+                continue
+            limiter.release(congested=True)
+            if slots is not None:
+                slots.release()
+            cDM_metrics.metrics.observe(endpoint_of(url), alias_of(url), time.monotonic() - started, 'error', 0)
+            raise urllib.error.URLError(e)
+        return PooledResponse(pool, parts.scheme, parts.netloc, conn, response, url, limiter, started, deadline, slots,
+                              timeouts['read'])
+
+
+def open_url(url, headers=None):
+    # drop-in for urllib.request.urlopen: follows redirects and raises HTTPError on 4xx/5xx.
+    for _ in range(MAX_REDIRECTS + 1):
+        response = pooled_request(url, headers)
+        # a redirect's or an error's body is read only to free the connection; if reading it
+        # fails, the with still gives back the connection and the limiter & request slots.
+        if response.status in (301, 302, 303, 307, 308) and response.headers.get('Location'):
+            with response:
+                response.read()
+            url = urllib.parse.urljoin(url, response.headers['Location'])
+            continue
+        if response.status >= 400:
+            with response:
+                body = response.read()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+        return response
+    raise urllib.error.URLError('too many redirects: {}'.format(url))
+
+
+def endpoint_of(url):
+    # 'dmGetItemInfo', 'GetParent', 'dmQuery', ... for dmwebservices urls; 'getfile' for binaries.
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qs(parts.query).get('q')
+    if query:
+        return query[0].split('/')[0]
+    if '/getfile/' in parts.path:
+        return 'getfile'
+    return parts.path.rstrip('/').split('/')[-1]
+
+
+TRANSIENT_ERRORS = (urllib.error.URLError, http.client.HTTPException, ConnectionError, TimeoutError, ssl.SSLError)
+
+
+def alias_of(url):
+    # the collection a request is about, or '' for repository-level calls.
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qs(parts.query).get('q')
+    if query:
+        segments = query[0].split('/')
+        return segments[1].split('|')[0] if len(segments) > 2 else ''
+    segments = parts.path.split('/')
+    if 'collection' in segments[:-1]:
+        return segments[segments.index('collection') + 1]
+    return ''
+
+
+def is_retryable(error):
+    if isinstance(error, CircuitOpen):
+        return False
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in RETRY_STATUSES
+    return True
+
+
+def backoff_delay(attempt, error):
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    retry_after = getattr(error, 'headers', None) and error.headers.get('Retry-After')
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, min(RETRY_MAX_DELAY, int(retry_after)))
+    return delay
+
+
+def retry_call(url, operation):
+    # runs operation(), retrying transient failures.  Whatever still fails is raised
+    # as a urllib.error.URLError (or its HTTPError subclass), so callers catch one type.
+    attempts = RETRY_ATTEMPTS.get(endpoint_of(url), DEFAULT_RETRY_ATTEMPTS)
+    breaker = get_breaker(host_of(url))
+    retry_budget.record_request()
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpen('circuit open for {}'.format(host_of(url)))
+        try:
+            result = operation()
+        except TRANSIENT_ERRORS as e:
+            error = e if isinstance(e, urllib.error.URLError) else urllib.error.URLError(e)
+            if is_retryable(error):
+                breaker.record_failure()
+            else:
+                # a 404 or the like: the host itself is answering fine.
+                breaker.record_success()
+            attempt += 1
+            if not is_retryable(error) or attempt >= attempts or not retry_budget.try_spend():
+                if error is e:
+                    raise
+                raise error from e
+            cDM_metrics.metrics.record_retry(endpoint_of(url), alias_of(url))
+            time.sleep(backoff_delay(attempt - 1, error))
+            continue
+        except BaseException:
+            # not the host's doing -- a bad gzip body, a full disk -- but a half-open
+            # breaker's trial has to end either way, or no request gets through again.
+            breaker.record_success()
+            raise
+        breaker.record_success()
+        return result
+
+
+def decode_body(body, content_encoding):
+    content_encoding = (content_encoding or '').strip().lower()
+    if content_encoding in ('gzip', 'x-gzip'):
+        return gzip.decompress(body)
+    if content_encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # some servers send a raw deflate stream without the zlib header.
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+def record_transfer(wire_bytes, decoded_bytes):
+    with transfer_stats_lock:
+        transfer_stats['wire_bytes'] += wire_bytes
+        transfer_stats['decoded_bytes'] += decoded_bytes
+
+
+def transfer_report():
+    with transfer_stats_lock:
+        wire, decoded = transfer_stats['wire_bytes'], transfer_stats['decoded_bytes']
+    return '{} bytes of xml/json received as {} bytes, {} saved by compression'.format(decoded, wire, decoded - wire)
+
+
+def read_text(response):
+    # read a piece at a time, so the response's total deadline is checked as the body comes in.
+    # The closing read() marks the response finished, so its connection goes back to the pool.
+    chunks = []
+    while True:
+        chunk = response.read1(CHUNK_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    chunks.append(response.read())
+    body = b''.join(chunks)
+    decoded = decode_body(body, response.headers.get('Content-Encoding'))
+    record_transfer(len(body), len(decoded))
+    return decoded.decode(encoding='utf-8')
+
+
+def fetch_text(url, fresh=False):
+    # fresh: a cached entry is revalidated however young it is.
+    ttl = CACHE_TTLS.get(endpoint_of(url))
+    if cache_dir and ttl is not None:
+        return fetch_text_cached(url, 0 if fresh else ttl)
+
+    def attempt():
+        with open_url(url, {'Accept-Encoding': TEXT_ACCEPT_ENCODING}) as response:
+            return read_text(response)
+    if hedging and endpoint_of(url) in HEDGED_ENDPOINTS:
+        return retry_call(url, lambda: hedged_call(url, attempt))
+    return retry_call(url, attempt)
+
+
+def hedged_call(url, operation):
+    # runs operation() and, if it is slower than the endpoint's recent p95, a second copy
+    # alongside it.  The first to succeed wins; the loser finishes in the background.
+    endpoint = endpoint_of(url)
+    delay = latency_tracker.quantile(endpoint, HEDGE_QUANTILE, HEDGE_MIN_SAMPLES)
+    hedge_budget.record_request()
+    outcomes = queue.Queue()
+
+    def run():
+        started = time.monotonic()
+        try:
+            result = operation()
+        except BaseException as e:
+            outcomes.put((False, e))
+            return
+        latency_tracker.record(endpoint, time.monotonic() - started)
+        outcomes.put((True, result))
+
+    if delay is None:
+        run()
+        return unwrap_outcome(outcomes.get())
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        return unwrap_outcome(outcomes.get(timeout=delay))
+    except queue.Empty:
+        pass
+    if not hedge_budget.try_spend():
+        return unwrap_outcome(outcomes.get())
+    cDM_metrics.metrics.record_hedge(endpoint, alias_of(url))
+    threading.Thread(target=run, daemon=True).start()
+    succeeded, value = outcomes.get()
+    if not succeeded:
+        # one copy failed; the other may still come through.
+        succeeded, value = outcomes.get()
+    return unwrap_outcome((succeeded, value))
+
+
+def unwrap_outcome(outcome):
+    succeeded, value = outcome
+    if succeeded:
+        return value
+    raise value
+
+
+def fetch_text_cached(url, ttl):
+    cached_meta, cached_text = read_cache_entry(url)
+    if cached_meta and time.time() - cached_meta['stored_at'] < ttl:
+        return cached_text
+    headers = {'Accept-Encoding': TEXT_ACCEPT_ENCODING}
+    if cached_meta and cached_meta.get('etag'):
+        headers['If-None-Match'] = cached_meta['etag']
+    if cached_meta and cached_meta.get('last_modified'):
+        headers['If-Modified-Since'] = cached_meta['last_modified']
+
+    def attempt():
+        with open_url(url, headers) as response:
+            text = read_text(response)
+            if response.status == 304:
+                return None, response.headers
+            return text, response.headers
+    text, response_headers = retry_call(url, attempt)
+    if text is None:
+        write_cache_entry(url, cached_text, cached_meta.get('etag'), cached_meta.get('last_modified'))
+        return cached_text
+    write_cache_entry(url, text, response_headers.get('ETag'), response_headers.get('Last-Modified'))
+    return text
+
+
+def cache_entry_paths(url):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    folder = os.path.join(cache_dir, key[:2])
+    return os.path.join(folder, '{}.body'.format(key)), os.path.join(folder, '{}.meta.json'.format(key))
+
+
+def read_cache_entry(url):
+    body_path, meta_path = cache_entry_paths(url)
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        with open(body_path, 'r', encoding='utf-8') as f:
+            return meta, f.read()
+    except (OSError, ValueError):
+        return None, None
+
+
+def write_cache_entry(url, text, etag, last_modified):
+    # written to a temp name & renamed, so a reader in another process never sees half a file.
+    body_path, meta_path = cache_entry_paths(url)
+    os.makedirs(os.path.dirname(body_path), exist_ok=True)
+    meta = {'url': url, 'stored_at': time.time(), 'etag': etag, 'last_modified': last_modified}
+    for path, content in ((body_path, text), (meta_path, json.dumps(meta))):
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+
+def collections_list_url():
+    return '{}dmGetCollectionList/xml'.format(url_prefix)
+
+
+def collection_metadata_url(alias):
+    return '{}dmGetCollectionArchivalInfo/{}/xml'.format(url_prefix, alias)
+
+
+def collection_total_recs_url(alias):
+    return '{}dmQueryTotalRecs/{}|0/xml'.format(url_prefix, alias)
+
+
+def collection_fields_url(alias, xml_or_json):
+    return '{}dmGetCollectionFieldInfo/{}/{}'.format(url_prefix, alias, xml_or_json)
+
+
+ELEMS_IN_COLLECTION_FIELDS = ('fullrs', 'find', 'dmaccess', 'dmimage', 'dmcreated', 'dmmodified', 'dmoclcno', 'dmrecord')
+
+
+# dmQuery pages through no more than its first DMQUERY_WINDOW hits; past that it
+# keeps answering with the last page it will give.
+DMQUERY_WINDOW = 10000
+
+
+def dmrecord_range(low, high):
+    # a dmQuery searchstring (field^string^mode^operator) for low <= dmrecord <= high.
+    return 'dmrecord^{}-{}^all^and'.format(low, high)
+
+
+def elems_in_collection_url(alias, starting_position, chunk_size, xml_or_json, fields=ELEMS_IN_COLLECTION_FIELDS,
+                            searchstrings='0'):
+    return '{}dmQuery/{}/{}/{}/nosort/{}/{}/1/0/0/0/0/0/{}'.format(
+        url_prefix, alias, searchstrings, '!'.join(fields), chunk_size, starting_position, xml_or_json)
+
+
+def item_metadata_url(alias, pointer, xml_or_json):
+    return '{}dmGetItemInfo/{}/{}/{}'.format(url_prefix, alias, pointer, xml_or_json)
+
+
+def compound_object_url(alias, pointer):
+    return '{}dmGetCompoundObjectInfo/{}/{}/xml'.format(url_prefix, alias, pointer)
+
+
+def parent_info_url(alias, pointer, xml_or_json):
+    return '{}GetParent/{}/{}/{}'.format(url_prefix, alias, pointer, xml_or_json)
 
 
 def retrieve_collections_list():
-    url = '{}dmGetCollectionList/xml'.format(url_prefix)
-    with urllib.request.urlopen(url) as response:
-        return response.read().decode(encoding='utf-8')
+    return fetch_text(collections_list_url())
 
 
 def retrieve_collection_metadata(alias):
-    url = '{}dmGetCollectionArchivalInfo/{}/xml'.format(url_prefix, alias)
-    with urllib.request.urlopen(url) as response:
-        return response.read().decode(encoding='utf-8')
+    return fetch_text(collection_metadata_url(alias))
 
 
-def retrieve_collection_total_recs(alias):
-    url = '{}dmQueryTotalRecs/{}|0/xml'.format(url_prefix, alias)
-    with urllib.request.urlopen(url) as response:
-        return response.read().decode(encoding='utf-8')
+def retrieve_collection_total_recs(alias, fresh=False):
+    return fetch_text(collection_total_recs_url(alias), fresh)
 
 
 def retrieve_collection_fields_xml(alias):
-    url = '{}dmGetCollectionFieldInfo/{}/xml'.format(url_prefix, alias)
-    with urllib.request.urlopen(url) as response:
-        return response.read().decode(encoding='utf-8')
+    return fetch_text(collection_fields_url(alias, 'xml'))
 
 
 def retrieve_collection_fields_json(alias):
-    url = '{}dmGetCollectionFieldInfo/{}/json'.format(url_prefix, alias)
-    with urllib.request.urlopen(url) as response:
-        return response.read().decode(encoding='utf-8')
+    return fetch_text(collection_fields_url(alias, 'json'))
 
 
-def retrieve_elems_in_collection(alias, starting_position, chunk_size, xml_or_json):
-    fields = 'fullrs!find!dmaccess!dmimage!dmcreated!dmmodified!dmoclcno!dmrecord'
-    url = '{}dmQuery/{}/0/{}/nosort/{}/{}/1/0/0/0/0/0/{}'.format(
-        url_prefix, alias, fields, chunk_size, starting_position, xml_or_json)
-    with urllib.request.urlopen(url) as response:
-        return response.read().decode(encoding='utf-8')
+def retrieve_elems_in_collection(alias, starting_position, chunk_size, xml_or_json, fields=ELEMS_IN_COLLECTION_FIELDS,
+                                 searchstrings='0'):
+    return fetch_text(elems_in_collection_url(alias, starting_position, chunk_size, xml_or_json, fields, searchstrings))
 
 
 def retrieve_item_metadata(alias, pointer, xml_or_json):
-    url = '{}dmGetItemInfo/{}/{}/{}'.format(url_prefix, alias, pointer, xml_or_json)
-    with urllib.request.urlopen(url) as response:
-        return response.read().decode(encoding='utf-8')
+    return fetch_text(item_metadata_url(alias, pointer, xml_or_json))
 
 
 def retrieve_compound_object(alias, pointer):
-    url = '{}dmGetCompoundObjectInfo/{}/{}/xml'.format(url_prefix, alias, pointer)
-    with urllib.request.urlopen(url) as response:
-        return response.read().decode(encoding='utf-8')
+    return fetch_text(compound_object_url(alias, pointer))
 
 
 def retrieve_parent_info(alias, pointer, xml_or_json):
-    url = '{}GetParent/{}/{}/{}'.format(url_prefix, alias, pointer, xml_or_json)
-    with urllib.request.urlopen(url) as response:
-        return response.read().decode(encoding='utf-8')
+    return fetch_text(parent_info_url(alias, pointer, xml_or_json))
+
+
+def binary_url(alias, pointer):
+    return '{}/{}/id/{}/filename/unused.unused'.format(binary_url_prefix, alias, pointer)
 
 
 def retrieve_binary(alias, pointer):
-    cdm_binary_url = 'https://cdm16313.contentdm.oclc.org/utils/getfile/collection'
-    url = '{}/{}/id/{}/filename/unused.unused'.format(cdm_binary_url, alias, pointer)
-    with urllib.request.urlopen(url) as response:
-        return response.read()
+    url = binary_url(alias, pointer)
+
+    def attempt():
+        with open_url(url) as response:
+            return response.read()
+    return retry_call(url, attempt)
+
+
+def download_binary_to_file(alias, pointer, folder, filename, filetype, reject_xml=False):
+    # Streams the binary into '<filename>.<filetype>.part' and renames it into place once
+    # its length checks out, so a file under its real name is always a whole download.
+    # An interrupted download keeps its .part file (and the server's validator, in
+    # .part.json); the next attempt -- a retry here, or a later run -- asks only for the
+    # missing bytes with a Range request.  Returns the size of the finished file.
+    # With reject_xml, a download that turns out to be an xml document -- contentDM's
+    # answer for some pointers with no binary of their own -- is discarded; returns None.
+    os.makedirs(folder, exist_ok=True)
+    filepath = os.path.join(folder, '{}.{}'.format(filename, filetype))
+    part_filepath = '{}.part'.format(filepath)
+    url = binary_url(alias, pointer)
+    size = retry_call(url, lambda: resume_download(url, part_filepath))
+    if reject_xml and starts_like_xml(part_filepath):
+        discard_part(part_filepath)
+        return None
+    os.replace(part_filepath, filepath)
+    if os.path.exists('{}.json'.format(part_filepath)):
+        os.remove('{}.json'.format(part_filepath))
+    return size
+
+
+def resume_download(url, part_filepath):
+    validator_filepath = '{}.json'.format(part_filepath)
+    offset = os.path.getsize(part_filepath) if os.path.exists(part_filepath) else 0
+    headers = dict()
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+        validator = read_validator(validator_filepath)
+        if validator:
+            # if the file changed on the server since, we get all of the new one instead.
+            headers['If-Range'] = validator
+    try:
+        response = open_url(url, headers)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset:
+            if content_range_total(e.headers.get('Content-Range')) == offset:
+                return offset    # the .part was already whole
+            discard_part(part_filepath)
+            return resume_download(url, part_filepath)
+        raise
+    with response:
+        if response.status == 206:
+            start, total = content_range_start_total(response.headers.get('Content-Range'))
+            if start != offset:
+                discard_part(part_filepath)
+                raise urllib.error.URLError('{} answered a range request with bytes from {}'.format(url, start))
+            mode, expected = 'ab', total
+        else:
+            offset, mode = 0, 'wb'
+            content_length = response.headers.get('Content-Length')
+            expected = int(content_length) if content_length and content_length.isdigit() else None
+        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        if validator:
+            with open(validator_filepath, 'w') as f:
+                json.dump({'validator': validator}, f)
+        watchdog = ThroughputWatchdog(url, MIN_THROUGHPUT, STALL_WINDOW)
+        with open(part_filepath, mode) as f:
+            while True:
+                chunk = response.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                offset += len(chunk)
+                watchdog.update(len(chunk))
+    if expected is not None and offset != expected:
+        raise http.client.IncompleteRead(b'', expected - offset)
+    return offset
+
+
+def starts_like_xml(filepath, sniff_size=4096):
+    # text that opens with a tag -- a binary (%PDF, a jpeg's ff d8) fails one test or the other.
+    with open(filepath, 'rb') as f:
+        head = f.read(sniff_size)
+    try:
+        text = codecs.getincrementaldecoder('utf-8-sig')().decode(head, final=False)
+    except UnicodeDecodeError:
+        return False
+    return text.lstrip().startswith('<')
+
+
+def read_validator(validator_filepath):
+    try:
+        with open(validator_filepath, 'r') as f:
+            return json.load(f).get('validator')
+    except (OSError, ValueError):
+        return None
+
+
+def content_range_start_total(content_range):
+    # 'bytes 100-199/1000' -> (100, 1000); total is None for 'bytes 100-199/*'
+    try:
+        byte_range, total = content_range.split(' ', 1)[1].split('/')
+        return int(byte_range.split('-')[0]), None if total == '*' else int(total)
+    except (AttributeError, IndexError, ValueError):
+        return None, None
+
+
+def content_range_total(content_range):
+    # 'bytes */1000' -> 1000
+    try:
+        return int(content_range.split('/')[1])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def discard_part(part_filepath):
+    for filepath in (part_filepath, '{}.json'.format(part_filepath)):
+        if os.path.exists(filepath):
+            os.remove(filepath)
 
 
 def write_xml_to_file(xml_text, folder, filename):
@@ -91,4 +1035,4 @@ def write_binary_to_file(binary, folder, filename, filetype):
     os.makedirs(folder, exist_ok=True)
     filepath = os.path.join(folder, '{}.{}'.format(filename, filetype))
     with open(filepath, 'bw') as f:
-        f.write(binary)
+        return f.write(binary)
@@ -0,0 +1,312 @@
+#! /usr/bin/env python3
+
+import asyncio
+import http.client
+import io
+import os
+import ssl
+import time
+import urllib.error
+import urllib.parse
+
+import cDM_api_calls as CdmAPI
+import cDM_metrics
+
+# asyncio flavour of cDM_api_calls: the same calls, built from the same urls, but as
+# coroutines, so that hundreds of requests can wait on the network at once from one
+# process.  Every coroutine runs on the one event loop behind run(), and a single
+# semaphore caps how many requests are in flight at a time.
+#
+#     texts = CdmAPIAsync.run_all(
+#         CdmAPIAsync.retrieve_item_metadata(alias, p, 'xml') for p in pointers)
+
+MAX_IN_FLIGHT = 100
+
+_loop = None
+_semaphore = None
+
+
+def get_event_loop():
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+    return _loop
+
+
+def run(coroutine):
+    return get_event_loop().run_until_complete(coroutine)
+
+
+def run_all(coroutines):
+    # gather has to be called inside the loop, or its future lands on another loop.
+    async def gather_all():
+        return await asyncio.gather(*coroutines)
+    return run(gather_all())
+
+
+def get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+    return _semaphore
+
+
+def set_max_in_flight(max_in_flight):
+    global MAX_IN_FLIGHT, _semaphore
+    MAX_IN_FLIGHT = max_in_flight
+    _semaphore = None
+
+
+class AsyncConnectionPool():
+    def __init__(self, pool_size=CdmAPI.POOL_SIZE, idle_timeout=CdmAPI.IDLE_TIMEOUT):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.idle = dict()
+
+    async def get_connection(self, scheme, host):
+        # returns (reader, writer, was_reused)
+        idle = self.idle.get((scheme, host), [])
+        now = time.monotonic()
+        while idle:
+            reader, writer, released_at = idle.pop()
+            if now - released_at < self.idle_timeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await new_connection(scheme, host)
+        return reader, writer, False
+
+    def put_connection(self, scheme, host, reader, writer):
+        idle = self.idle.setdefault((scheme, host), [])
+        if len(idle) < self.pool_size:
+            idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    def close_all(self):
+        idle_lists, self.idle = list(self.idle.values()), dict()
+        for idle in idle_lists:
+            for _, writer, _ in idle:
+                writer.close()
+
+
+connection_pool = AsyncConnectionPool()
+
+
+async def new_connection(scheme, host):
+    parts = urllib.parse.urlsplit('{}://{}'.format(scheme, host))
+    if scheme == 'https':
+        return await asyncio.open_connection(parts.hostname, parts.port or 443, ssl=ssl.create_default_context())
+    return await asyncio.open_connection(parts.hostname, parts.port or 80)
+
+
+class AsyncResponse():
+    # Counterpart of CdmAPI.PooledResponse.  The connection goes back to the pool on
+    # close only if the body was read through and the server agreed to keep it alive.
+    def __init__(self, pool, scheme, host, reader, writer, url, status, reason, headers, keep_alive, started):
+        self.pool = pool
+        self.scheme = scheme
+        self.host = host
+        self.reader = reader
+        self.writer = writer
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.keep_alive = keep_alive
+        self.body_done = status in (204, 304)
+        self.started = started
+        self.received = 0
+
+    async def iter_chunks(self, chunk_size=CdmAPI.CHUNK_SIZE):
+        if self.body_done:
+            return
+        reader = self.reader
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                async for chunk in read_exactly(reader, size, chunk_size):
+                    self.received += len(chunk)
+                    yield chunk
+                await reader.readexactly(2)
+        elif self.headers.get('Content-Length') is not None:
+            async for chunk in read_exactly(reader, int(self.headers['Content-Length']), chunk_size):
+                self.received += len(chunk)
+                yield chunk
+        else:
+            self.keep_alive = False
+            while True:
+                chunk = await reader.read(chunk_size)
+                if not chunk:
+                    break
+                self.received += len(chunk)
+                yield chunk
+        self.body_done = True
+
+    async def read(self):
+        return b''.join([chunk async for chunk in self.iter_chunks()])
+
+    def close(self):
+        if self.writer is None:
+            return
+        if self.body_done and self.keep_alive:
+            self.pool.put_connection(self.scheme, self.host, self.reader, self.writer)
+        else:
+            self.writer.close()
+        self.writer = None
+        cDM_metrics.metrics.observe(CdmAPI.endpoint_of(self.url), CdmAPI.alias_of(self.url),
+                        time.monotonic() - self.started, self.status, self.received)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+
+async def read_exactly(reader, size, chunk_size):
+    remaining = size
+    while remaining > 0:
+        chunk = await reader.read(min(remaining, chunk_size))
+        if not chunk:
+            raise http.client.IncompleteRead(b'', remaining)
+        remaining -= len(chunk)
+        yield chunk
+
+
+async def pooled_request(url, headers=None):
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path = '{}?{}'.format(path, parts.query)
+    request_headers = {'Host': parts.netloc, 'Connection': 'keep-alive', 'Accept-Encoding': 'identity'}
+    request_headers.update(headers or {})
+    request_bytes = 'GET {} HTTP/1.1\r\n{}\r\n'.format(
+        path, ''.join('{}: {}\r\n'.format(k, v) for k, v in request_headers.items())).encode('latin-1')
+    pool = connection_pool
+    while True:
+        try:
+            reader, writer, reused = await pool.get_connection(parts.scheme, parts.netloc)
+        except OSError as e:
+            raise urllib.error.URLError(e)
+        started = time.monotonic()
+        try:
+            writer.write(request_bytes)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                raise http.client.RemoteDisconnected('Remote end closed connection without response')
+            version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+            header_lines = []
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                header_lines.append(line)
+        except (http.client.HTTPException, OSError) as e:
+            writer.close()
+            if reused:
+                # the server may have dropped an idle keep-alive connection.
+                continue
+            cDM_metrics.metrics.observe(CdmAPI.endpoint_of(url), CdmAPI.alias_of(url), time.monotonic() - started, 'error', 0)
+            raise urllib.error.URLError(e)
+        response_headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines) + b'\r\n'))
+        keep_alive = version == 'HTTP/1.1' and response_headers.get('Connection', '').lower() != 'close'
+        return AsyncResponse(pool, parts.scheme, parts.netloc, reader, writer, url,
+                             int(status), reason, response_headers, keep_alive, started)
+
+
+async def open_url(url, headers=None):
+    for _ in range(CdmAPI.MAX_REDIRECTS + 1):
+        response = await pooled_request(url, headers)
+        if response.status in (301, 302, 303, 307, 308) and response.headers.get('Location'):
+            await response.read()
+            response.close()
+            url = urllib.parse.urljoin(url, response.headers['Location'])
+            continue
+        if response.status >= 400:
+            body = await response.read()
+            response.close()
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+        return response
+    raise urllib.error.URLError('too many redirects: {}'.format(url))
+
+
+async def fetch_text(url):
+    async with get_semaphore():
+        async with await open_url(url, {'Accept-Encoding': CdmAPI.TEXT_ACCEPT_ENCODING}) as response:
+            body = await response.read()
+    decoded = CdmAPI.decode_body(body, response.headers.get('Content-Encoding'))
+    CdmAPI.record_transfer(len(body), len(decoded))
+    return decoded.decode(encoding='utf-8')
+
+
+async def retrieve_collections_list():
+    return await fetch_text(CdmAPI.collections_list_url())
+
+
+async def retrieve_collection_metadata(alias):
+    return await fetch_text(CdmAPI.collection_metadata_url(alias))
+
+
+async def retrieve_collection_total_recs(alias):
+    return await fetch_text(CdmAPI.collection_total_recs_url(alias))
+
+
+async def retrieve_collection_fields_xml(alias):
+    return await fetch_text(CdmAPI.collection_fields_url(alias, 'xml'))
+
+
+async def retrieve_collection_fields_json(alias):
+    return await fetch_text(CdmAPI.collection_fields_url(alias, 'json'))
+
+
+async def retrieve_elems_in_collection(alias, starting_position, chunk_size, xml_or_json,
+                                       fields=CdmAPI.ELEMS_IN_COLLECTION_FIELDS, searchstrings='0'):
+    return await fetch_text(CdmAPI.elems_in_collection_url(alias, starting_position, chunk_size, xml_or_json, fields,
+                                                           searchstrings))
+
+
+async def retrieve_item_metadata(alias, pointer, xml_or_json):
+    return await fetch_text(CdmAPI.item_metadata_url(alias, pointer, xml_or_json))
+
+
+async def retrieve_compound_object(alias, pointer):
+    return await fetch_text(CdmAPI.compound_object_url(alias, pointer))
+
+
+async def retrieve_parent_info(alias, pointer, xml_or_json):
+    return await fetch_text(CdmAPI.parent_info_url(alias, pointer, xml_or_json))
+
+
+async def retrieve_binary(alias, pointer):
+    async with get_semaphore():
+        async with await open_url(CdmAPI.binary_url(alias, pointer)) as response:
+            return await response.read()
+
+
+async def download_binary_to_file(alias, pointer, folder, filename, filetype):
+    # Streams the binary into '<filename>.<filetype>.part' and renames it into place when
+    # done; returns its size.  Simpler than CdmAPI.download_binary_to_file: one attempt,
+    # no timeouts or stall watchdog, no Range requests, and on any failure the .part file
+    # is deleted, so the next try starts over.
+    os.makedirs(folder, exist_ok=True)
+    filepath = os.path.join(folder, '{}.{}'.format(filename, filetype))
+    part_filepath = '{}.part'.format(filepath)
+    size = 0
+    try:
+        async with get_semaphore():
+            async with await open_url(CdmAPI.binary_url(alias, pointer)) as response:
+                with open(part_filepath, 'bw') as f:
+                    async for chunk in response.iter_chunks():
+                        f.write(chunk)
+                        size += len(chunk)
+    except BaseException:
+        if os.path.exists(part_filepath):
+            os.remove(part_filepath)
+        raise
+    os.replace(part_filepath, filepath)
+    return size
@@ -0,0 +1,210 @@
+#! /usr/bin/env python3
+
+import json
+import os
+import threading
+import time
+
+# Request metrics for cDM_api_calls & cDM_async_api_calls, labelled by endpoint
+# ('dmGetItemInfo', 'GetParent', 'dmQuery', 'getfile', ...) and by alias.  For each
+# (endpoint, alias) we keep a latency histogram, bytes received, a count per status
+# code ('error' when no response came back at all), and the numbers of retries & hedges.
+#
+# start_exporter() writes them every `interval` seconds to
+#     cDM_metrics.prom  -- Prometheus text exposition format
+#     cDM_metrics.json  -- the same numbers as a summary, with rough p50/p95 latencies
+#
+# A forked worker process starts with empty metrics of its own; it hands them back with
+# drain(), and the parent folds them into its own with merge().  start_forwarding() and
+# start_merging() do that every `interval` seconds through a multiprocessing queue, so
+# a worker's long alias is in the parent's files while it runs.
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+EXPORT_INTERVAL = 60
+
+
+class RequestMetrics():
+    def __init__(self):
+        self.series = dict()
+        self.lock = threading.Lock()
+
+    def get_series(self, endpoint, alias):
+        key = (endpoint, alias)
+        if key not in self.series:
+            self.series[key] = {'count': 0,
+                                'latency_sum': 0.0,
+                                'buckets': [0] * len(LATENCY_BUCKETS),
+                                'bytes': 0,
+                                'statuses': dict(),
+                                'retries': 0,
+                                'hedges': 0, }
+        return self.series[key]
+
+    def observe(self, endpoint, alias, latency, status, nbytes):
+        with self.lock:
+            series = self.get_series(endpoint, alias)
+            series['count'] += 1
+            series['latency_sum'] += latency
+            for num, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    series['buckets'][num] += 1
+                    break
+            series['bytes'] += nbytes
+            status = str(status)
+            series['statuses'][status] = series['statuses'].get(status, 0) + 1
+
+    def record_retry(self, endpoint, alias):
+        with self.lock:
+            self.get_series(endpoint, alias)['retries'] += 1
+
+    def record_hedge(self, endpoint, alias):
+        with self.lock:
+            self.get_series(endpoint, alias)['hedges'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {key: json.loads(json.dumps(series)) for key, series in self.series.items()}
+
+    def drain(self):
+        # a snapshot of everything since the last drain, which is then forgotten here.
+        with self.lock:
+            series, self.series = self.series, dict()
+        return series
+
+    def merge(self, snapshot):
+        with self.lock:
+            for (endpoint, alias), other in snapshot.items():
+                series = self.get_series(endpoint, alias)
+                for field in ('count', 'latency_sum', 'bytes', 'retries', 'hedges'):
+                    series[field] += other[field]
+                series['buckets'] = [i + j for i, j in zip(series['buckets'], other['buckets'])]
+                for status, count in other['statuses'].items():
+                    series['statuses'][status] = series['statuses'].get(status, 0) + count
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = ['# HELP cdm_request_duration_seconds Time from sending a request to closing its response.',
+                 '# TYPE cdm_request_duration_seconds histogram']
+        for (endpoint, alias), series in sorted(snapshot.items()):
+            labels = 'endpoint="{}",alias="{}"'.format(endpoint, alias)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, series['buckets']):
+                cumulative += count
+                lines.append('cdm_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, cumulative))
+            lines.append('cdm_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, series['count']))
+            lines.append('cdm_request_duration_seconds_sum{{{}}} {}'.format(labels, series['latency_sum']))
+            lines.append('cdm_request_duration_seconds_count{{{}}} {}'.format(labels, series['count']))
+        lines += ['# HELP cdm_response_bytes_total Bytes received in response bodies.',
+                  '# TYPE cdm_response_bytes_total counter']
+        for (endpoint, alias), series in sorted(snapshot.items()):
+            lines.append('cdm_response_bytes_total{{endpoint="{}",alias="{}"}} {}'.format(endpoint, alias, series['bytes']))
+        lines += ['# HELP cdm_responses_total Responses by status code.',
+                  '# TYPE cdm_responses_total counter']
+        for (endpoint, alias), series in sorted(snapshot.items()):
+            for status, count in sorted(series['statuses'].items()):
+                lines.append('cdm_responses_total{{endpoint="{}",alias="{}",status="{}"}} {}'.format(
+                    endpoint, alias, status, count))
+        lines += ['# HELP cdm_retries_total Requests retried after a transient failure.',
+                  '# TYPE cdm_retries_total counter']
+        for (endpoint, alias), series in sorted(snapshot.items()):
+            lines.append('cdm_retries_total{{endpoint="{}",alias="{}"}} {}'.format(endpoint, alias, series['retries']))
+        lines += ['# HELP cdm_hedges_total Duplicate requests sent after a slow first answer.',
+                  '# TYPE cdm_hedges_total counter']
+        for (endpoint, alias), series in sorted(snapshot.items()):
+            lines.append('cdm_hedges_total{{endpoint="{}",alias="{}"}} {}'.format(endpoint, alias, series['hedges']))
+        return '\n'.join(lines) + '\n'
+
+    def to_summary(self):
+        summary = []
+        for (endpoint, alias), series in sorted(self.snapshot().items()):
+            summary.append({'endpoint': endpoint,
+                            'alias': alias,
+                            'requests': series['count'],
+                            'mean_latency': series['latency_sum'] / series['count'] if series['count'] else None,
+                            'p50_latency': bucket_quantile(series, 0.5),
+                            'p95_latency': bucket_quantile(series, 0.95),
+                            'bytes': series['bytes'],
+                            'statuses': series['statuses'],
+                            'retries': series['retries'],
+                            'hedges': series['hedges'], })
+        return {'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'series': summary}
+
+    def write_files(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for filename, content in (('cDM_metrics.prom', self.to_prometheus()),
+                                  ('cDM_metrics.json', json.dumps(self.to_summary(), indent=2))):
+            filepath = os.path.join(directory, filename)
+            temp_filepath = '{}.tmp'.format(filepath)
+            with open(temp_filepath, 'w') as f:
+                f.write(content)
+            os.replace(temp_filepath, filepath)
+
+
+def bucket_quantile(series, quantile):
+    # upper bound of the histogram bucket holding the quantile -- coarse, but enough to compare endpoints.
+    if not series['count']:
+        return None
+    target = quantile * series['count']
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, series['buckets']):
+        cumulative += count
+        if cumulative >= target:
+            return bound
+    return '+Inf'
+
+
+metrics = RequestMetrics()
+
+
+def reset_after_fork():
+    # the child gets none of the parent's series -- they'd be counted twice once merged
+    # back -- nor a lock the parent's exporter thread may have held.
+    global metrics
+    metrics = RequestMetrics()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def start_exporter(directory, interval=EXPORT_INTERVAL):
+    # returns a function that writes the files one last time and stops the exporter.
+    stopping = threading.Event()
+
+    def export_loop():
+        while not stopping.wait(interval):
+            metrics.write_files(directory)
+        metrics.write_files(directory)
+    thread = threading.Thread(target=export_loop, name='cDM_metrics exporter', daemon=True)
+    thread.start()
+
+    def stop():
+        stopping.set()
+        thread.join()
+    return stop
+
+
+def start_forwarding(queue, interval=EXPORT_INTERVAL):
+    # in a worker process: puts what drain() gives on queue every interval, for good.
+    def forward_loop():
+        while True:
+            time.sleep(interval)
+            snapshot = metrics.drain()
+            if snapshot:
+                queue.put(snapshot)
+    thread = threading.Thread(target=forward_loop, name='cDM_metrics forwarder', daemon=True)
+    thread.start()
+
+
+def start_merging(queue):
+    # in the parent: merges whatever start_forwarding() puts on queue.  Returns a
+    # function that merges what's left in it and stops.
+    def merge_loop():
+        for snapshot in iter(queue.get, None):
+            metrics.merge(snapshot)
+    thread = threading.Thread(target=merge_loop, name='cDM_metrics merger', daemon=True)
+    thread.start()
+
+    def stop():
+        queue.put(None)
+        thread.join()
+    return stop
@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+
+import sqlite3
+import threading
+import time
+
+# What became of every artifact ScrapeAlias has asked contentDM for, kept in sqlite so
+# a rerun can tell "already on disk" and "known to be missing" apart from "never tried"
+# without listing directories.  One row per (alias, pointer, artifact), where artifact
+# is one of ARTIFACTS, holding the latest status, when it was recorded & its size.
+# Root-level items also keep the dmmodified they had when they were last harvested,
+# which is what ScrapeAlias's incremental mode compares against.
+#
+# Several processes may share one file (see scrape_cDM.do_all_collections): the database
+# runs in WAL mode and waits up to BUSY_TIMEOUT seconds for another writer.
+
+STATE_FILENAME = 'scrape_state.sqlite'
+BUSY_TIMEOUT = 30
+
+ARTIFACTS = ('xml', 'json', 'parent_xml', 'parent_json', 'cpd_xml', 'binary')
+
+FETCHED = 'fetched'
+NOT_FOUND = '404'
+HTTP_ERROR = 'http-error'
+SKIPPED = 'skipped'
+
+# statuses that mean there is no point asking again.
+SETTLED = (FETCHED, NOT_FOUND)
+
+
+class ScrapeState():
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS artifacts (
+                                     alias TEXT NOT NULL,
+                                     pointer TEXT NOT NULL,
+                                     artifact TEXT NOT NULL,
+                                     status TEXT NOT NULL,
+                                     recorded_at REAL NOT NULL,
+                                     bytes INTEGER NOT NULL DEFAULT 0,
+                                     PRIMARY KEY (alias, pointer, artifact))""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS items (
+                                     alias TEXT NOT NULL,
+                                     pointer TEXT NOT NULL,
+                                     dmmodified TEXT NOT NULL,
+                                     recorded_at REAL NOT NULL,
+                                     PRIMARY KEY (alias, pointer))""")
+
+    def record(self, alias, pointer, artifact, status, nbytes=0):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)',
+                              (alias, str(pointer), artifact, status, time.time(), nbytes))
+
+    def status(self, alias, pointer, artifact):
+        with self.lock:
+            row = self.conn.execute('SELECT status FROM artifacts WHERE alias = ? AND pointer = ? AND artifact = ?',
+                                    (alias, str(pointer), artifact)).fetchone()
+        return row[0] if row else None
+
+    def statuses(self, alias):
+        # {(pointer, artifact): status} for the whole alias, read in one query.
+        with self.lock:
+            rows = self.conn.execute('SELECT pointer, artifact, status FROM artifacts WHERE alias = ?',
+                                     (alias, )).fetchall()
+        return {(pointer, artifact): status for pointer, artifact, status in rows}
+
+    def record_modified(self, alias, pointer, dmmodified):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)',
+                              (alias, str(pointer), dmmodified, time.time()))
+
+    def modified_dates(self, alias):
+        # {pointer: dmmodified when last harvested}
+        with self.lock:
+            rows = self.conn.execute('SELECT pointer, dmmodified FROM items WHERE alias = ?', (alias, )).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,27 @@
+#! /usr/bin/python3
+
+import pytest
+import cDM_api_calls
+import fake_cDM_server
+
+
+@pytest.fixture
+def fake_cdm_aliases():
+    # the synthetic aliases fake_cdm_fixture serves; a test module overrides this
+    # fixture to serve its own.
+    return {'fakecoll1': {'simple': 6, 'compound': 2, 'children': 3, 'pdfpage': 1,
+                          'missing': [4], 'binary_size': 3000}}
+
+
+@pytest.fixture
+def fake_cdm_fixture(fake_cdm_aliases, monkeypatch):
+    config = fake_cDM_server.load_config(None)
+    config['aliases'] = fake_cdm_aliases
+    fake_cdm = fake_cDM_server.FakeContentDM(config).start()
+    monkeypatch.setattr(cDM_api_calls, 'url_prefix', fake_cdm.api_url_prefix)
+    monkeypatch.setattr(cDM_api_calls, 'binary_url_prefix', fake_cdm.binary_url_prefix)
+    monkeypatch.setattr(cDM_api_calls, 'cache_dir', None)
+    monkeypatch.setattr(cDM_api_calls, 'RETRY_BASE_DELAY', 0)
+    yield fake_cdm
+    fake_cdm.shutdown()
+    cDM_api_calls.configure_connection_pool()
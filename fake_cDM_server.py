@@ -0,0 +1,390 @@
+#! /usr/bin/env python3
+
+import argparse
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+from xml.sax.saxutils import escape
+
+"""
+A stand-in for contentDM's dmwebservices & getfile servers, serving a synthetic
+repository, so scrape_cDM.py can be run, tested and benchmarked with no network.
+
+    python3 fake_cDM_server.py --config my_repo.json --api-port 8080 --binary-port 8081
+
+then point cDM_api_calls at it with the two CDM_*_URL_PREFIX variables it prints.
+
+The config (DEFAULT_CONFIG shows every key) describes, per alias, how many simple
+objects, compound objects (and children per compound), and pdfpage pseudo-compounds
+to make, which pointers answer "Requested item not found", and how big each binary is.
+"latency" adds a delay per endpoint, in seconds, "error_rate" makes that fraction of
+an endpoint's requests fail with a 503, "truncate_rate" makes that fraction stop
+halfway through the body, and "trickle" sends an endpoint's body a byte at a time,
+that many seconds apart.  getfile honours Range requests.
+
+Pointers are handed out in order within an alias: simple objects first, then each
+compound's children followed by the compound itself, as contentDM numbers them.
+"""
+
+
+DEFAULT_CONFIG = {
+    'aliases': {
+        'fakecoll1': {'simple': 20,
+                      'compound': 3,
+                      'children': 4,
+                      'pdfpage': 1,
+                      'missing': [],
+                      'binary_size': 4096, },
+    },
+    'latency': {},       # e.g. {'dmGetItemInfo': 0.05, 'getfile': 0.2}
+    'error_rate': {},    # e.g. {'GetParent': 0.01}
+    'truncate_rate': {},    # e.g. {'getfile': 0.05} -- sends half the body, then drops the connection
+    'trickle': {},    # e.g. {'dmGetItemInfo': 0.1} -- one byte of body every 0.1 seconds
+    'dmquery_window': 10000,
+    'seed': 0,
+}
+
+COLLECTION_FIELDS = (('Title', 'title'), ('Creator', 'creato'), ('Subject', 'subjec'),
+                     ('Description', 'descri'), ('Date', 'date'), ('Format', 'format'))
+NOT_FOUND = {'code': '-2', 'message': 'Requested item not found', 'restrictionCode': '-1'}
+
+
+class FakeRepository():
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.random = random.Random(config.get('seed', 0))
+        self.request_counts = dict()
+        self.items = dict()    # alias -> {pointer: item dict}
+        for alias, alias_config in config['aliases'].items():
+            self.items[alias] = self.build_alias(alias, alias_config)
+
+    def build_alias(self, alias, alias_config):
+        items = dict()
+        missing = {str(i) for i in alias_config.get('missing', [])}
+        pointer = 0
+
+        def new_item(filetype, parent='-1', title=None):
+            nonlocal pointer
+            item = {'pointer': str(pointer),
+                    'filetype': filetype,
+                    'parent': parent,
+                    'title': title or '{} item {}'.format(alias, pointer),
+                    'dmmodified': '2017-01-01',
+                    'missing': str(pointer) in missing,
+                    'children': [],
+                    'cpd_type': None, }
+            items[item['pointer']] = item
+            pointer += 1
+            return item
+
+        for _ in range(alias_config.get('simple', 0)):
+            new_item(('jp2', 'pdf', 'mp4', 'tif')[pointer % 4])
+        for kind, count in (('Document', alias_config.get('compound', 0)),
+                            ('Document-PDF', alias_config.get('pdfpage', 0))):
+            for _ in range(count):
+                children = [new_item('jp2' if kind == 'Document' else 'pdfpage')
+                            for _ in range(alias_config.get('children', 2))]
+                parent = new_item('cpd')
+                parent['cpd_type'] = kind
+                parent['children'] = [child['pointer'] for child in children]
+                for child in children:
+                    child['parent'] = parent['pointer']
+        return items
+
+    def root_items(self, alias):
+        return [item for item in self.items.get(alias, {}).values() if item['parent'] == '-1']
+
+    def get_item(self, alias, pointer):
+        item = self.items.get(alias, {}).get(pointer)
+        if item is None or item['missing']:
+            return None
+        return item
+
+    def touch(self, alias, pointer, dmmodified):
+        self.items[alias][str(pointer)]['dmmodified'] = dmmodified
+
+    def count_request(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def roll(self, rates_key, endpoint):
+        rate = self.config.get(rates_key, {}).get(endpoint, 0)
+        with self.lock:
+            return bool(rate) and self.random.random() < rate
+
+    def binary_for(self, alias, item):
+        size = self.config['aliases'][alias].get('binary_size', 4096)
+        # starts with a byte that is never valid utf-8, as a real pdf/jp2 header would.
+        pattern = '\x89{} {} '.format(alias, item['pointer']).encode('latin-1')
+        return (pattern * (size // len(pattern) + 1))[:size]
+
+    def item_fields(self, alias, item):
+        if item['filetype'] == 'cpd':
+            find = '{}.cpd'.format(int(item['pointer']) + 1)
+            file_format = 'pdf' if item['cpd_type'] == 'Document-PDF' else ''
+        else:
+            find = '{}.{}'.format(int(item['pointer']) + 1, item['filetype'])
+            file_format = item['filetype']
+        fields = {'title': item['title'],
+                  'creato': 'Fake Creator',
+                  'subjec': 'Testing; Benchmarking',
+                  'descri': 'A synthetic {} object'.format(item['filetype']),
+                  'date': '1900-01-01',
+                  'format': file_format,
+                  'fullrs': '',
+                  'find': find,
+                  'dmaccess': '',
+                  'dmimage': '',
+                  'dmcreated': '2017-01-01',
+                  'dmmodified': item['dmmodified'],
+                  'dmoclcno': '',
+                  'dmrecord': item['pointer'], }
+        return fields
+
+
+def to_xml(root_tag, content):
+    # content is a dict of text/dicts/lists, in the order contentDM writes them.
+    return '<?xml version="1.0" encoding="UTF-8"?>{}'.format(xml_elem(root_tag, content))
+
+
+def xml_elem(tag, content):
+    if isinstance(content, dict):
+        inner = ''.join(xml_elem(k, v) for k, v in content.items())
+    elif isinstance(content, list):
+        return ''.join(xml_elem(tag, i) for i in content)
+    else:
+        inner = escape(str(content))
+    return '<{0}>{1}</{0}>'.format(tag, inner)
+
+
+def to_json(content):
+    def empty_to_object(value):
+        if isinstance(value, dict):
+            return {k: empty_to_object(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [empty_to_object(i) for i in value]
+        return value if value != '' else {}
+    return json.dumps(empty_to_object(content), separators=(',', ':')).replace('/', '\\/')
+
+
+class FakeContentDMHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        repository = self.server.repository
+        if parts.path.startswith('/utils/getfile/collection/'):
+            endpoint, args = 'getfile', parts.path.split('/')[4:]
+        else:
+            query = urllib.parse.parse_qs(parts.query).get('q', [''])[0]
+            endpoint, *args = query.split('/')
+        repository.count_request(endpoint)
+        time.sleep(repository.config.get('latency', {}).get(endpoint, 0))
+        self.trickle = repository.config.get('trickle', {}).get(endpoint)
+        if repository.roll('error_rate', endpoint):
+            return self.send_body(503, b'Service Unavailable', 'text/plain')
+        self.truncating = repository.roll('truncate_rate', endpoint)
+        handler = getattr(self, 'do_{}'.format(endpoint), None)
+        if handler is None:
+            return self.send_body(404, b'Not Found', 'text/plain')
+        handler(repository, *args)
+
+    def send_body(self, status, body, content_type, extra_headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (extra_headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        if getattr(self, 'truncating', False):
+            # promise the whole body, send half of it, and hang up.
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        if getattr(self, 'trickle', None):
+            for num in range(len(body)):
+                self.wfile.write(body[num:num + 1])
+                self.wfile.flush()
+                time.sleep(self.trickle)
+            return
+        self.wfile.write(body)
+
+    def send_content(self, root_tag, content, xml_or_json):
+        if xml_or_json == 'json':
+            return self.send_body(200, to_json(content).encode('utf-8'), 'application/json')
+        return self.send_body(200, to_xml(root_tag, content).encode('utf-8'), 'text/xml')
+
+    def send_not_found(self, xml_or_json):
+        # contentDM answers a missing item with a 200 and an error document.
+        self.send_content('error', NOT_FOUND, xml_or_json)
+
+    def do_dmGetCollectionList(self, repository, xml_or_json='xml'):
+        collections = [{'alias': '/{}'.format(alias), 'name': alias, 'path': '/fake/{}'.format(alias)}
+                       for alias in repository.items]
+        self.send_content('collections', {'collection': collections}, xml_or_json)
+
+    def do_dmGetCollectionArchivalInfo(self, repository, alias, xml_or_json='xml'):
+        self.send_content('archivalinfo', {'alias': alias, 'name': alias}, xml_or_json)
+
+    def do_dmQueryTotalRecs(self, repository, alias_and_zero, xml_or_json='xml'):
+        alias = alias_and_zero.split('|')[0]
+        total = len(repository.root_items(alias))
+        self.send_content('results', {'totalrecs': {'suggestedtopic': '', 'total': total}}, xml_or_json)
+
+    def do_dmGetCollectionFieldInfo(self, repository, alias, xml_or_json='xml'):
+        fields = [{'name': name, 'nick': nick, 'type': 'TEXT', 'size': '0', 'find': 'i{}'.format(num),
+                   'req': '0', 'search': '1', 'hide': '0', 'vocdb': '', 'vocab': '0', 'dc': 'BLANK',
+                   'admin': '0', 'readonly': '0'}
+                  for num, (name, nick) in enumerate(COLLECTION_FIELDS)]
+        if xml_or_json == 'json':
+            return self.send_body(200, to_json(fields).encode('utf-8'), 'application/json')
+        self.send_content('fields', {'field': fields}, xml_or_json)
+
+    def do_dmQuery(self, repository, alias, searchstrings, fields, sortby, maxrecs, start, *rest):
+        xml_or_json = rest[-1] if rest else 'xml'
+        records = self.server.query_records(alias, searchstrings)
+        window = repository.config.get('dmquery_window', 10000)
+        # like contentDM, nothing past the first `window` hits can be paged to.
+        start = min(int(start), window + 1)
+        page = records[start - 1:min(start - 1 + int(maxrecs), window)]
+        requested = [i for i in fields.split('!') if i]
+        rendered = []
+        for item in page:
+            item_fields = repository.item_fields(alias, item)
+            record = {'collection': '/{}'.format(alias),
+                      'pointer': item['pointer'],
+                      'filetype': item['filetype'],
+                      'parentobject': '-1'}
+            record.update((field, item_fields.get(field, '')) for field in requested)
+            rendered.append(record)
+        pager = {'start': start, 'maxrecs': maxrecs, 'total': len(records)}
+        if xml_or_json == 'json':
+            return self.send_body(200, to_json({'pager': pager, 'records': rendered}).encode('utf-8'),
+                                  'application/json')
+        self.send_content('results', {'pager': pager, 'records': {'record': rendered}}, xml_or_json)
+
+    def do_dmGetItemInfo(self, repository, alias, pointer, xml_or_json='xml'):
+        item = repository.get_item(alias, pointer)
+        if item is None:
+            return self.send_not_found(xml_or_json)
+        content = repository.item_fields(alias, item)
+        size = len(repository.binary_for(alias, item)) if item['filetype'] != 'cpd' else 0
+        content.update({'restrictionCode': '1', 'cdmfilesize': str(size),
+                        'cdmfilesizeformatted': '{:.2f} MB'.format(size / 1024 / 1024),
+                        'cdmprintpdf': '0', 'cdmhasocr': '0', 'cdmisnewspaper': '0'})
+        self.send_content('xml', content, xml_or_json)
+
+    def do_GetParent(self, repository, alias, pointer, xml_or_json='xml'):
+        item = repository.get_item(alias, pointer)
+        if item is None:
+            return self.send_not_found(xml_or_json)
+        if xml_or_json == 'json':
+            return self.send_body(200, json.dumps({'parent': int(item['parent'])}).encode('utf-8'),
+                                  'application/json')
+        self.send_body(200, to_xml('parent', item['parent']).encode('utf-8'), 'text/xml')
+
+    def do_dmGetCompoundObjectInfo(self, repository, alias, pointer, xml_or_json='xml'):
+        item = repository.get_item(alias, pointer)
+        if item is None or item['filetype'] != 'cpd':
+            return self.send_not_found(xml_or_json)
+        pages = []
+        for num, child_pointer in enumerate(item['children']):
+            child = repository.items[alias][child_pointer]
+            pagefile = '{}.{}'.format(int(child_pointer) + 1, 'pdfpage' if child['filetype'] == 'pdfpage' else 'jp2')
+            pages.append({'pagetitle': 'Page {}'.format(num + 1), 'pagefile': pagefile, 'pageptr': child_pointer})
+        self.send_content('cpd', {'type': item['cpd_type'], 'page': pages}, xml_or_json)
+
+    def do_getfile(self, repository, alias, _id='id', pointer=None, *rest):
+        item = repository.get_item(alias, pointer)
+        if item is None or item['filetype'] == 'pdfpage':
+            return self.send_body(404, b'Not Found', 'text/plain')
+        if item['filetype'] == 'cpd' and item['cpd_type'] != 'Document-PDF':
+            # a plain compound has no binary of its own; contentDM sends its index xml instead.
+            return self.do_dmGetCompoundObjectInfo(repository, alias, pointer)
+        body = repository.binary_for(alias, item)
+        etag = '"{}-{}-{}"'.format(alias, pointer, len(body))
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range', etag) == etag:
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(body):
+                return self.send_body(416, b'', 'text/plain', {'Content-Range': 'bytes */{}'.format(len(body))})
+            repository.count_request('getfile_range')
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body))
+            return self.send_body(206, body[start:], 'application/octet-stream', headers)
+        self.send_body(200, body, 'application/octet-stream', headers)
+
+
+class FakeContentDMServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, repository):
+        super().__init__(address, FakeContentDMHandler)
+        self.repository = repository
+
+    def query_records(self, alias, searchstrings):
+        # only dmrecord ranges (dmrecord^low-high^mode^operator) are honoured; any other
+        # searchstring matches every root-level item.
+        records = sorted(self.repository.root_items(alias), key=lambda item: int(item['pointer']))
+        for searchstring in searchstrings.split('!'):
+            field, _, rest = searchstring.partition('^')
+            low, _, high = rest.split('^')[0].partition('-')
+            if field == 'dmrecord' and low.isdigit() and high.isdigit():
+                records = [i for i in records if int(low) <= int(i['pointer']) <= int(high)]
+        return records
+
+
+class FakeContentDM():
+    # Runs the api and the getfile servers on two ports in background threads, so the
+    # two hosts stay as distinct to cDM_api_calls as server16313 & cdm16313 are.
+    def __init__(self, config=None, host='127.0.0.1', api_port=0, binary_port=0):
+        self.repository = FakeRepository(config or DEFAULT_CONFIG)
+        self.api_server = FakeContentDMServer((host, api_port), self.repository)
+        self.binary_server = FakeContentDMServer((host, binary_port), self.repository)
+        self.api_url_prefix = 'http://{}:{}/dmwebservices/index.php?q='.format(host, self.api_server.server_address[1])
+        self.binary_url_prefix = 'http://{}:{}/utils/getfile/collection'.format(host, self.binary_server.server_address[1])
+        self.threads = []
+
+    def start(self):
+        for server in (self.api_server, self.binary_server):
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def shutdown(self):
+        for server in (self.api_server, self.binary_server):
+            server.shutdown()
+            server.server_close()
+
+
+def load_config(filepath):
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    if filepath:
+        with open(filepath, 'r') as f:
+            config.update(json.load(f))
+    return config
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a synthetic contentDM repository.')
+    parser.add_argument('--config', help='json file shaped like DEFAULT_CONFIG')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--api-port', type=int, default=8080)
+    parser.add_argument('--binary-port', type=int, default=8081)
+    args = parser.parse_args()
+    fake_cdm = FakeContentDM(load_config(args.config), args.host, args.api_port, args.binary_port).start()
+    print('export CDM_API_URL_PREFIX="{}"'.format(fake_cdm.api_url_prefix))
+    print('export CDM_BINARY_URL_PREFIX="{}"'.format(fake_cdm.binary_url_prefix))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake_cdm.shutdown()
@@ -1,8 +1,11 @@
 #! /usr/bin/env python3
 
 import os
+import sys
 import lxml.etree as etree
-import urllib.request
+
+sys.path.append(os.path.join(os.pardir, os.pardir))
+import cDM_api_calls as CdmAPI
 
 
 def list_alias_cmp_types(alias):
@@ -23,9 +26,8 @@ def list_alias_cmp_types(alias):
 
 
 def list_all_aliases():
-    url = 'https://server16313.contentdm.oclc.org/dmwebservices/index.php?q=dmGetCollectionList/xml'
-    with urllib.request.urlopen(url) as response:
-        coll_list_etree = etree.parse(response)
+    coll_list_text = CdmAPI.retrieve_collections_list()
+    coll_list_etree = etree.fromstring(coll_list_text.encode('utf-8'))
     return [i.text.strip('/') for i in coll_list_etree.findall('.//alias')]
 
 
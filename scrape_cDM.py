@@ -5,8 +5,14 @@ import urllib
 from lxml import etree as ET
 import json
 import logging
+import multiprocessing
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import cDM_api_calls as CdmAPI
+import cDM_metrics
+import cDM_state
 
 
 WE_DONT_MIGRATE = {'p16313coll70', 'p120701coll11', 'LSUHSCS_JCM', 'UNO_SCC', 'p15140coll36', 'p15140coll57',
@@ -27,6 +33,20 @@ WE_DONT_MIGRATE = {'p16313coll70', 'p120701coll11', 'LSUHSCS_JCM', 'UNO_SCC', 'p
                    'p15140coll9', 'p15140coll59', 'p16313coll40', 'p15140coll53', 'p16313coll97',
                    'p16313coll18', 'p15140coll33', 'LST', 'MPF', 'p15140coll2', }
 
+# where write_metadata puts each metadata artifact, by pointer.
+METADATA_FILENAMES = {'xml': '{}.xml',
+                      'json': '{}.json',
+                      'parent_xml': '{}_parent.xml',
+                      'parent_json': '{}_parent.json',
+                      'cpd_xml': '{}_cpd.xml', }
+
+# an alias too big for one dmQuery window is listed in dmrecord ranges; once this many
+# ranges in a row come back empty, the rest of the count is taken to be unlistable.
+MAX_EMPTY_PARTITIONS = 100
+
+# where harvested aliases go, one directory each, beside scrape_state.sqlite.
+REPO_DIR = os.path.join('..', 'Cached_Cdm_files')
+
 
 
 """
@@ -51,24 +71,64 @@ Cachec_Cdm_files-
 
 
 class ScrapeAlias():
-    def __init__(self, repo_dir, alias):
+    chunksize = 1024    # records per Elems_in_Collection page
+
+    def __init__(self, repo_dir, alias, fetch_once=False, bulk_metadata=False, workers=8, state=None,
+                 incremental=False):
         self.alias = alias
         self.alias_dir = os.path.realpath(os.path.join(repo_dir, self.alias))
         self.compound_parents = []
-        self.tree_snapshot = []
+        # compound pointer -> its children's pointers, as compound_items() read them.
+        self.compound_children = dict()
+        # directory -> set of the filenames in it; built by build_file_index() and kept
+        # current as files are written, so each "already on disk?" check is one set lookup.
+        self.file_index = dict()
+        # work put off until everything else in the alias is done: binaries whose download
+        # timed out or stalled, and anything bound for a host whose circuit breaker is open.
+        # Entries are (url, pointer, function, args); see defer() & do_deferred_work().
+        self.deferred = []
+        # fetch_once: ask contentDM for the xml only, and write each json twin by
+        # converting that xml locally -- half the requests per pointer.
+        self.fetch_once = fetch_once
+        # bulk_metadata: ask dmQuery for every field in Collection_Fields.xml, and write
+        # root-level item metadata, and the parent info in each record's parentobject,
+        # straight from those pages.  Only records that come back incomplete are left
+        # for per-pointer dmGetItemInfo & GetParent calls.  dmQuery can't return the
+        # admin fields dmGetItemInfo adds (restrictionCode, cdmfilesize, cdmprintpdf, ...),
+        # so bulk-written item xml & json lack them.
+        self.bulk_metadata = bulk_metadata
+        # workers: how many pointers are worked on at once.  Their log lines are held
+        # back and written in pointer order, so a log reads the same at any setting.
+        self.workers = workers
+        # state: a cDM_state.ScrapeState.  With one, what was fetched or found missing on
+        # an earlier run is looked up there -- known 404s are not asked for again.
+        self.state = state
+        self.known = state.statuses(alias) if state is not None else dict()
+        # incremental: re-list the collection and refetch the metadata & binaries of every
+        # root-level item whose dmmodified differs from the one stored in state when it
+        # was last harvested (and, for a compound, its children too).  Needs a state.
+        self.incremental = incremental and state is not None
+        self.root_modified = dict()
+        self.harvested = dict()
+        self.stale_pointers = set()
+        self.listed_compounds = []
+        self.listed_pointers = set()
 
     def main(self):
         self.do_collection_level_metadata()
         self.do_root_level_objects()
         self.do_compound_objects()
+        self.do_deferred_work()
+        self.record_harvested_dates()
 
     def do_collection_level_metadata(self):
         filepath = self.alias_dir
         os.makedirs(filepath, exist_ok=True)
         files = [i for i in os.listdir(filepath)]
-        if 'Collection_TotalRecs.xml' not in files:
+        if 'Collection_TotalRecs.xml' not in files or self.incremental:
+            # an incremental run is looking for new items; a cached count could hide them.
             CdmAPI.write_xml_to_file(
-                CdmAPI.retrieve_collection_total_recs(self.alias),
+                CdmAPI.retrieve_collection_total_recs(self.alias, fresh=self.incremental),
                 filepath,
                 'Collection_TotalRecs')
             logging.info('{} Collection_TotalRecs.xml written'.format(self.alias))
@@ -92,16 +152,148 @@ class ScrapeAlias():
             logging.info('{} Collection_Fields.xml written'.format(self.alias))
 
     def do_root_level_objects(self):
-        chunksize = 1024
-        num_chunks = self.calculate_chunks(chunksize)
-        for num in range(num_chunks):
-            starting_position = (num * chunksize) + 1
-            if starting_position > 10001:
-                starting_position = 10001
-            self.write_chunk_of_elems_in_collection(starting_position, chunksize)
-        self.tree_snapshot = [i for i in os.walk(self.alias_dir)]
-        for pointer, filetype in self.find_root_pointers_filetypes():
+        self.build_file_index()
+        if self.incremental:
+            self.harvested = self.state.modified_dates(self.alias)
+        self.listed_compounds = []
+        self.run_in_order(self.process_root_level_pointer, self.listed_root_pointers())
+        # compounds were appended as their workers finished; put them back in pointer order.
+        position = {pointer: num for num, pointer in enumerate(self.listed_compounds)}
+        self.compound_parents.sort(key=position.get)
+
+    def listed_root_pointers(self):
+        # Yields every root-level (pointer, filetype) once, a page at a time as the
+        # Elems_in_Collection pages arrive, so item work starts with the first page.
+        # dmmodified & the bulk metadata are taken in the same pass over each page.
+        seen = self.listed_pointers = set()
+        fields = self.bulk_fields() if self.bulk_metadata else None
+
+        def read_listed_record(pointer, filetype, single_record):
+            dmmodified = single_record.findtext('dmmodified')
+            if self.state is not None and dmmodified:
+                self.root_modified[pointer] = dmmodified
+            if fields:
+                self.write_bulk_record(single_record, pointer, filetype, fields)
+
+        for filename in self.elems_in_collection_pages():
+            files = ['{}.xml'.format(filename)]
+            for pointer, filetype in self.find_root_pointers_filetypes(files, seen, read_listed_record):
+                if self.incremental:
+                    self.forget_if_modified(pointer, filetype)
+                if filetype == 'cpd':
+                    self.listed_compounds.append(pointer)
+                yield pointer, filetype
+
+    def process_root_level_pointer(self, pointer, filetype):
+        try:
             self.process_root_level_objects(pointer, filetype)
+        except CdmAPI.CircuitOpen as e:
+            logging.warning('{} {} deferred: {}'.format(self.alias, pointer, e))
+            self.skip_root_level_metadata(pointer, filetype)
+            self.defer(CdmAPI.item_metadata_url(self.alias, pointer, 'xml'), pointer,
+                       self.process_deferred_root_level_object, pointer, filetype)
+        except urllib.error.URLError as e:
+            # CdmAPI has already retried; skip this pointer so the rest of the alias carries on.
+            logging.warning('{} {} skipped after retries: {}'.format(self.alias, pointer, e))
+            self.skip_root_level_metadata(pointer, filetype)
+
+    def skip_root_level_metadata(self, pointer, filetype):
+        if filetype == 'cpd':
+            self.skip_metadata(os.path.join(self.alias_dir, 'Cpd'), pointer, 'cpd')
+        else:
+            self.skip_metadata(self.alias_dir, pointer, 'simple')
+
+    def record_harvested_dates(self):
+        # An item's dmmodified is stored only once all of it, and all of a compound's
+        # children, is settled.  Until then the old date stays, and the next incremental
+        # run refetches the item rather than take what is on disk as current.
+        unsettled = {pointer for (pointer, artifact), status in self.known.items()
+                     if status not in cDM_state.SETTLED}
+        for pointer, dmmodified in self.root_modified.items():
+            if pointer in unsettled or unsettled.intersection(self.compound_children.get(pointer, ())):
+                continue
+            self.state.record_modified(self.alias, pointer, dmmodified)
+
+    def forget_if_modified(self, pointer, filetype):
+        # Items harvested before dmmodified was stored are taken as current.
+        dmmodified = self.root_modified.get(pointer)
+        if pointer in self.harvested and dmmodified and self.harvested[pointer] != dmmodified:
+            logging.info('{} {} modified since last harvest, refetching'.format(self.alias, pointer))
+            self.stale_pointers.add(pointer)
+            self.forget(self.alias_dir, pointer, filetype)
+            self.forget(os.path.join(self.alias_dir, 'Cpd'), pointer, filetype)
+
+    def forget(self, target_dir, pointer, filetype=None):
+        # drops what self.known & self.file_index hold for pointer, so all of it is fetched again.
+        # Workers add to the same sets meanwhile, so only pointer's own names are discarded;
+        # a compound's hidden pdf is refetched because pointer is in self.stale_pointers.
+        for artifact in cDM_state.ARTIFACTS:
+            self.known.pop((pointer, artifact), None)
+        files = self.files_in(target_dir)
+        names = list(METADATA_FILENAMES.values())
+        if filetype:
+            names += ['{}.' + filetype, '{}.' + filetype.lower()]
+        for name in names:
+            files.discard(name.format(pointer))
+
+    def run_in_order(self, function, items):
+        for result in self.map_in_order(function, items):
+            pass
+
+    def map_in_order(self, function, items, ahead=None):
+        # Yields function(*item) for every item, run on self.workers threads with at most
+        # `ahead` items queued (two per worker unless told otherwise).  Each item's log
+        # records are replayed, and its exception re-raised, in the order of items.
+        # Records logged while items itself comes up with the next item -- a listing
+        # generator's page lines -- are replayed just before that item's, and those after
+        # its last item at the end, so how far ahead items are queued never shows in the log.
+        ahead = ahead or 2 * self.workers
+        items = iter(items)
+        log_buffer = LogBuffer()
+        root_logger = logging.getLogger()
+        root_logger.addFilter(log_buffer)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pending = collections.deque()
+                while True:
+                    lead_records, item, error = log_buffer.capture(next, items, None)
+                    if item is None:
+                        break
+                    pending.append((lead_records, executor.submit(log_buffer.capture, function, *item)))
+                    if len(pending) >= ahead:
+                        lead, future = pending.popleft()
+                        yield replay(future.result(), lead)
+                while pending:
+                    lead, future = pending.popleft()
+                    yield replay(future.result(), lead)
+                replay((lead_records, None, error))
+        finally:
+            root_logger.removeFilter(log_buffer)
+
+    def build_file_index(self):
+        self.file_index = {root: set(files) for root, dirs, files in os.walk(self.alias_dir)}
+
+    def files_in(self, directory):
+        return self.file_index.get(directory, set())
+
+    def add_to_file_index(self, directory, filename):
+        self.file_index.setdefault(directory, set()).add(filename)
+
+    def have(self, target_dir, filename, pointer, artifact):
+        # settled in the state database, or on disk -- a tree harvested before the
+        # database existed is still taken as it is.
+        if self.known.get((pointer, artifact)) in cDM_state.SETTLED:
+            return True
+        return filename in self.files_in(target_dir)
+
+    def record(self, pointer, artifact, status, nbytes=0):
+        self.known[(pointer, artifact)] = status
+        if self.state is not None:
+            self.state.record(self.alias, pointer, artifact, status, nbytes)
+
+    def written(self, target_dir, filename, pointer, artifact, nbytes):
+        self.add_to_file_index(target_dir, filename)
+        self.record(pointer, artifact, cDM_state.FETCHED, nbytes)
 
     def calculate_chunks(self, chunksize):
         num_root_objects = self.count_root_objects()
@@ -112,34 +304,142 @@ class ScrapeAlias():
         this_elem = total_recs_etree.xpath('.//total')
         return int(this_elem[0].text)
 
-    def write_chunk_of_elems_in_collection(self, starting_position, chunksize):
+    def elems_in_collection_pages(self):
+        # Yields the filename (less suffix) of each Elems_in_Collection page in order.
+        # Every page Collection_TotalRecs.xml calls for is asked for at once.
+        if self.count_root_objects() <= CdmAPI.DMQUERY_WINDOW:
+            pages = [((num * self.chunksize) + 1, self.chunksize) for num in range(self.calculate_chunks(self.chunksize))]
+            yield from self.map_in_order(self.write_chunk_of_elems_in_collection, pages, ahead=len(pages))
+        else:
+            yield from self.partitioned_elems_in_collection_pages()
+
+    def partitioned_elems_in_collection_pages(self):
+        # dmQuery won't page past its first DMQUERY_WINDOW hits, so the alias is listed in
+        # dmrecord ranges DMQUERY_WINDOW wide -- none can hold more than a window's worth.
+        # Each round asks for as few ranges as could still hold the records not yet listed,
+        # their first pages in parallel, then the rest of their pages in parallel.
+        # What counts as listed is self.listed_pointers, which listed_root_pointers fills
+        # from each page before asking for the next -- not the pager totals, which would
+        # add up just the same if dmQuery ignored the ranges.
+        num_root_objects = self.count_root_objects()
+        width = CdmAPI.DMQUERY_WINDOW
+        low, empty_partitions = 0, 0
+        while len(self.listed_pointers) < num_root_objects and empty_partitions < MAX_EMPTY_PARTITIONS:
+            listed_before = len(self.listed_pointers)
+            num_partitions = -(-(num_root_objects - listed_before) // width)
+            partitions = [(low + num * width, low + (num + 1) * width - 1) for num in range(num_partitions)]
+            low += num_partitions * width
+            first_pages = [(1, self.chunksize, partition) for partition in partitions]
+            later_pages = []
+            for partition, filename in zip(partitions, self.map_in_order(
+                    self.write_chunk_of_elems_in_collection, first_pages, ahead=len(first_pages))):
+                total = self.count_listed_records(filename)
+                yield filename
+                if total > width:
+                    # no range this wide can match more than `width` records.
+                    logging.warning('{} dmQuery ignored the dmrecord range {}-{}'.format(self.alias, *partition))
+                    return self.warn_if_incompletely_listed(num_root_objects)
+                empty_partitions = empty_partitions + 1 if not total else 0
+                later_pages.extend((starting_position, self.chunksize, partition)
+                                   for starting_position in range(1 + self.chunksize, total + 1, self.chunksize))
+            yield from self.map_in_order(self.write_chunk_of_elems_in_collection, later_pages, ahead=len(later_pages))
+            if len(self.listed_pointers) == listed_before and not empty_partitions:
+                logging.warning('{} dmrecord ranges from {} on listed nothing new'.format(
+                    self.alias, partitions[0][0]))
+                break
+        self.warn_if_incompletely_listed(num_root_objects)
+
+    def warn_if_incompletely_listed(self, num_root_objects):
+        if len(self.listed_pointers) < num_root_objects:
+            logging.warning('{} only {} of {} root-level records could be listed'.format(
+                self.alias, len(self.listed_pointers), num_root_objects))
+
+    def count_listed_records(self, filename):
+        # the <pager><total> of an Elems_in_Collection page: how many records its query
+        # matched.  The pager comes first, so the records after it are never read.
+        for event, total_elem in ET.iterparse(os.path.join(self.alias_dir, '{}.xml'.format(filename)), tag='total'):
+            if total_elem.getparent().tag == 'pager':
+                return int(total_elem.text or 0)
+        return 0
+
+    def write_chunk_of_elems_in_collection(self, starting_position, chunksize, dmrecords=None):
+        # dmrecords: a (low, high) dmrecord range to list, rather than the whole alias.
         filepath = self.alias_dir
         files = [i for i in os.listdir(filepath)]
-        if 'Elems_in_Collection_{}.json'.format(starting_position) not in files:
+        fields = self.bulk_fields() if self.bulk_metadata else CdmAPI.ELEMS_IN_COLLECTION_FIELDS
+        searchstrings = CdmAPI.dmrecord_range(*dmrecords) if dmrecords else '0'
+        filename = elems_filename(starting_position, dmrecords)
+        if self.incremental:
+            files = []    # the listing is what tells us what changed, so it is always fresh.
+        if '{}.json'.format(filename) not in files:
             CdmAPI.write_json_to_file(
-                CdmAPI.retrieve_elems_in_collection(self.alias, starting_position, chunksize, 'json'),
+                CdmAPI.retrieve_elems_in_collection(self.alias, starting_position, chunksize, 'json', fields,
+                                                    searchstrings),
                 filepath,
-                'Elems_in_Collection_{}'.format(starting_position))
-            logging.info('{} Elems_in_Collection_{}.json written'.format(self.alias, starting_position))
-        if 'Elems_in_Collection_{}.xml'.format(starting_position) not in files:
+                filename)
+            logging.info('{} {}.json written'.format(self.alias, filename))
+        if '{}.xml'.format(filename) not in files:
             CdmAPI.write_xml_to_file(
-                CdmAPI.retrieve_elems_in_collection(alias, starting_position, chunksize, 'xml'),
+                CdmAPI.retrieve_elems_in_collection(self.alias, starting_position, chunksize, 'xml', fields,
+                                                    searchstrings),
                 filepath,
-                'Elems_in_Collection_{}'.format(starting_position))
-            logging.info('{} Elems_in_Collection_{}.xml written'.format(self.alias, starting_position))
-
-    def find_root_pointers_filetypes(self):
+                filename)
+            logging.info('{} {}.xml written'.format(self.alias, filename))
+        return filename
+
+    def bulk_fields(self):
+        # every field nick in the collection, in Collection_Fields.xml order, then the dm* admin fields.
+        fields_etree = ET.parse(os.path.join(self.alias_dir, 'Collection_Fields.xml'))
+        fields = [nick.text for nick in fields_etree.findall('.//field/nick') if nick.text]
+        return tuple(fields + [i for i in CdmAPI.ELEMS_IN_COLLECTION_FIELDS if i not in fields])
+
+    def write_bulk_record(self, single_record, pointer, filetype, fields):
+        # what the record can't stand in for is left to write_metadata's per-pointer calls.
+        target_dir = os.path.join(self.alias_dir, 'Cpd') if filetype == 'cpd' else self.alias_dir
+        if not self.have(target_dir, '{}.xml'.format(pointer), pointer, 'xml'):
+            xml_text = bulk_record_to_item_xml(single_record, fields)
+            if xml_text is not None:
+                self.write_bulk_xml_and_json(xml_text, target_dir, pointer, pointer, 'xml', 'json')
+                logging.info('{} {} metadata written from bulk dmQuery'.format(self.alias, pointer))
+        if not self.have(target_dir, '{}_parent.xml'.format(pointer), pointer, 'parent_xml'):
+            xml_parent_text = bulk_record_to_parent_xml(single_record)
+            if xml_parent_text is not None:
+                self.write_bulk_xml_and_json(xml_parent_text, target_dir, '{}_parent'.format(pointer), pointer,
+                                             'parent_xml', 'parent_json')
+
+    def write_bulk_xml_and_json(self, xml_text, target_dir, filename, pointer, xml_artifact, json_artifact):
+        CdmAPI.write_xml_to_file(xml_text, target_dir, filename)
+        self.written(target_dir, '{}.xml'.format(filename), pointer, xml_artifact, len(xml_text.encode('utf-8')))
+        if not self.have(target_dir, '{}.json'.format(filename), pointer, json_artifact):
+            json_text = xml_to_cdm_json(xml_text)
+            CdmAPI.write_json_to_file(json_text, target_dir, filename)
+            self.written(target_dir, '{}.json'.format(filename), pointer, json_artifact, len(json_text.encode('utf-8')))
+
+    def elems_in_collection_files(self):
+        return [file for file in os.listdir(self.alias_dir) if 'Elems_in_Collection' in file and '.xml' in file]
+
+    def find_root_pointers_filetypes(self, files=None, seen=None, read_record=None):
+        # Yields (pointer, filetype) as each record is read, clearing it once read, so
+        # memory stays flat however many records a page holds.  A pointer already in
+        # seen is passed over -- dmrecord-range pages and whole-alias pages from an
+        # earlier run overlap.  read_record(pointer, filetype, record) gets each new
+        # record before it's cleared.
         filepath = self.alias_dir
-        files = [file for file in os.listdir(filepath) if 'Elems_in_Collection' in file and '.xml' in file]
-        pointers_filetypes = []
+        files = files or self.elems_in_collection_files()
+        seen = set() if seen is None else seen
         for file in files:
-            elems_in_col_etree = ET.parse(os.path.join(filepath, file))
-            for single_record in elems_in_col_etree.findall('.//record'):
-                pointer = single_record.find('dmrecord').text or single_record.find('pointer').text
-                filetype = single_record.find('filetype').text.lower()
-                if pointer and filetype:
-                    pointers_filetypes.append((pointer, filetype))
-        return pointers_filetypes
+            for event, single_record in ET.iterparse(os.path.join(filepath, file), tag='record'):
+                pointer = single_record.findtext('dmrecord') or single_record.findtext('pointer')
+                filetype = (single_record.findtext('filetype') or '').lower()
+                new = pointer and filetype and pointer not in seen
+                if new and read_record is not None:
+                    read_record(pointer, filetype, single_record)
+                single_record.clear()
+                while single_record.getprevious() is not None:
+                    del single_record.getparent()[0]
+                if new:
+                    seen.add(pointer)
+                    yield pointer, filetype
 
     def process_root_level_objects(self, pointer, filetype):
         if filetype == 'cpd':
@@ -151,73 +451,199 @@ class ScrapeAlias():
             self.write_metadata(self.alias_dir, pointer, 'simple')
             self.process_binary(self.alias_dir, pointer, filetype)
 
+    def process_deferred_root_level_object(self, pointer, filetype):
+        # do_compound_objects has already run by now, so a compound's children are done here.
+        self.process_root_level_objects(pointer, filetype)
+        if filetype == 'cpd':
+            os.makedirs(os.path.join(self.alias_dir, 'Cpd', pointer), exist_ok=True)
+            self.write_child_data(pointer)
+
     def write_metadata(self, target_dir, pointer, simple_or_cpd):
-        # checks presence of file before calling to contentDM or overwriting file
-        # there can be up to 4000 files checked here per alias,
-        # so it is useful to take a snapshot of the directory tree beforehand,
-        # instead of reading from the harddrive for each file.
-        files = [file for root, dirs, files in self.tree_snapshot
-                 for file in files
-                 if target_dir == root]
-
-        if "{}.xml".format(pointer) not in files:
-            xml_text = CdmAPI.retrieve_item_metadata(self.alias, pointer, 'xml')
+        # checks presence of file before calling to contentDM or overwriting file.
+        # the checks go to self.known & self.file_index rather than the harddrive --
+        # there can be thousands of files per alias.
+        xml_text, xml_parent_text = None, None
+        if not self.have(target_dir, '{}.xml'.format(pointer), pointer, 'xml'):
+            xml_text = self.fetch(pointer, 'xml', CdmAPI.retrieve_item_metadata, self.alias, pointer, 'xml')
             if is_it_a_404_xml(xml_text):
                 logging.warning('{} {}.xml is 404'.format(self.alias, pointer))
+                self.record(pointer, 'xml', cDM_state.NOT_FOUND)
             else:
                 CdmAPI.write_xml_to_file(xml_text, target_dir, pointer)
+                self.written(target_dir, '{}.xml'.format(pointer), pointer, 'xml', len(xml_text.encode('utf-8')))
                 logging.info('{} {} xml_text written'.format(self.alias, pointer))
 
-        if '{}.json'.format(pointer) not in files:
-            json_text = CdmAPI.retrieve_item_metadata(self.alias, pointer, 'json')
-            if is_it_a_404_json(json_text):
+        if not self.have(target_dir, '{}.json'.format(pointer), pointer, 'json'):
+            json_text = self.json_twin(xml_text, target_dir, pointer, pointer, 'xml', 'json',
+                                       CdmAPI.retrieve_item_metadata)
+            if json_text is None or is_it_a_404_json(json_text):
                 logging.warning('{} {}.json is 404'.format(self.alias, pointer))
+                self.record(pointer, 'json', cDM_state.NOT_FOUND)
             else:
                 CdmAPI.write_json_to_file(json_text, target_dir, pointer)
+                self.written(target_dir, '{}.json'.format(pointer), pointer, 'json', len(json_text.encode('utf-8')))
                 logging.info('{} {} json_text written'.format(self.alias, pointer))
 
-        if '{}_parent.xml'.format(pointer) not in files:
-            xml_parent_text = CdmAPI.retrieve_parent_info(self.alias, pointer, 'xml')
+        if not self.have(target_dir, '{}_parent.xml'.format(pointer), pointer, 'parent_xml'):
+            xml_parent_text = self.fetch(pointer, 'parent_xml', CdmAPI.retrieve_parent_info, self.alias, pointer, 'xml')
             if is_it_a_404_xml(xml_parent_text):
                 logging.warning('{} {}_parent.xml is 404'.format(self.alias, pointer))
+                self.record(pointer, 'parent_xml', cDM_state.NOT_FOUND)
             else:
                 CdmAPI.write_xml_to_file(xml_parent_text, target_dir, '{}_parent'.format(pointer))
+                self.written(target_dir, '{}_parent.xml'.format(pointer), pointer, 'parent_xml', len(xml_parent_text.encode('utf-8')))
                 logging.info('{} {} xml_parent_text written'.format(self.alias, pointer))
 
-        if '{}_parent.json'.format(pointer) not in files:
-            json_parent_text = CdmAPI.retrieve_parent_info(self.alias, pointer, 'json')
-            if is_it_a_404_json(json_parent_text):
+        if not self.have(target_dir, '{}_parent.json'.format(pointer), pointer, 'parent_json'):
+            json_parent_text = self.json_twin(xml_parent_text, target_dir, '{}_parent'.format(pointer), pointer,
+                                              'parent_xml', 'parent_json', CdmAPI.retrieve_parent_info)
+            if json_parent_text is None or is_it_a_404_json(json_parent_text):
                 logging.warning('{} {}_parent.json is 404'.format(self.alias, pointer))
+                self.record(pointer, 'parent_json', cDM_state.NOT_FOUND)
             else:
                 CdmAPI.write_json_to_file(json_parent_text, target_dir, '{}_parent'.format(pointer))
+                self.written(target_dir, '{}_parent.json'.format(pointer), pointer, 'parent_json', len(json_parent_text.encode('utf-8')))
                 logging.info('{} {} json_parent_text written'.format(self.alias, pointer))
 
         if simple_or_cpd == 'cpd':
-            if '{}_cpd.xml'.format(pointer) not in files:
-                index_file_text = CdmAPI.retrieve_compound_object(self.alias, pointer)
+            if not self.have(target_dir, '{}_cpd.xml'.format(pointer), pointer, 'cpd_xml'):
+                index_file_text = self.fetch(pointer, 'cpd_xml', CdmAPI.retrieve_compound_object, self.alias, pointer)
                 if is_it_a_404_xml(index_file_text):
                     logging.warning('{} {}_cpd.xml is 404'.format(self.alias, pointer))
+                    self.record(pointer, 'cpd_xml', cDM_state.NOT_FOUND)
                 else:
                     CdmAPI.write_xml_to_file(index_file_text, target_dir, '{}_cpd'.format(pointer))
+                    self.written(target_dir, '{}_cpd.xml'.format(pointer), pointer, 'cpd_xml', len(index_file_text.encode('utf-8')))
                     logging.info('{} {} xml_index_file_text written'.format(self.alias, pointer))
 
+    def fetch(self, pointer, artifact, function, *args):
+        # a fetch that gives up is recorded against artifact before the error goes on up.
+        try:
+            return function(*args)
+        except urllib.error.HTTPError:
+            self.record(pointer, artifact, cDM_state.HTTP_ERROR)
+            raise
+        except urllib.error.URLError:
+            self.record(pointer, artifact, cDM_state.SKIPPED)
+            raise
+
+    def skip_metadata(self, target_dir, pointer, simple_or_cpd):
+        # after write_metadata gave up on pointer, whatever it never got to is recorded as skipped.
+        artifacts = METADATA_FILENAMES if simple_or_cpd == 'cpd' else [i for i in METADATA_FILENAMES if i != 'cpd_xml']
+        for artifact in artifacts:
+            filename = METADATA_FILENAMES[artifact].format(pointer)
+            if (pointer, artifact) not in self.known and filename not in self.files_in(target_dir):
+                self.record(pointer, artifact, cDM_state.SKIPPED)
+
+    def json_twin(self, xml_text, target_dir, filename, pointer, xml_artifact, json_artifact, retrieve):
+        # The json for filename.xml.  With fetch_once it is converted from that xml -- the
+        # text just fetched, else the file from an earlier run -- and is None when the xml
+        # is a known 404.  It is fetched when fetch_once is off or there's no xml to convert.
+        if self.fetch_once:
+            if xml_text is None and self.known.get((pointer, xml_artifact)) == cDM_state.NOT_FOUND:
+                return None
+            xml_filepath = os.path.join(target_dir, '{}.xml'.format(filename))
+            if xml_text is None and os.path.isfile(xml_filepath):
+                with open(xml_filepath, 'r') as f:
+                    xml_text = f.read()
+            if xml_text is not None:
+                return xml_to_cdm_json(xml_text)
+        return self.fetch(pointer, json_artifact, retrieve, self.alias, pointer, 'json')
+
     def process_binary(self, target_dir, pointer, filetype):
-        files = [file for root, dirs, files in self.tree_snapshot for file in files if target_dir == root]
-        if '{}.{}'.format(pointer, filetype) not in files and '{}.{}'.format(pointer, filetype.lower()) not in files:
+        if (not self.have(target_dir, '{}.{}'.format(pointer, filetype), pointer, 'binary') and
+                '{}.{}'.format(pointer, filetype.lower()) not in self.files_in(target_dir)):
             try:
-                CdmAPI.write_binary_to_file(
-                    CdmAPI.retrieve_binary(self.alias, pointer),
-                    target_dir,
-                    pointer,
-                    filetype)
-                logging.info('{} {}.{} written'.format(self.alias, pointer, filetype))
-            except urllib.error.HTTPError:
+                self.download_binary(target_dir, pointer, filetype)
+            except urllib.error.HTTPError as e:
                 logging.warning('{} {} HTTP error caught on binary'.format(self.alias, pointer))
+                self.record(pointer, 'binary', cDM_state.NOT_FOUND if e.code == 404 else cDM_state.HTTP_ERROR)
+            except urllib.error.URLError as e:
+                logging.warning('{} {} binary deferred: {}'.format(self.alias, pointer, e))
+                self.record(pointer, 'binary', cDM_state.SKIPPED)
+                self.defer(CdmAPI.binary_url(self.alias, pointer), pointer,
+                           self.download_binary, target_dir, pointer, filetype)
+
+    def download_binary(self, target_dir, pointer, filetype):
+        size = CdmAPI.download_binary_to_file(self.alias, pointer, target_dir, pointer, filetype)
+        self.written(target_dir, '{}.{}'.format(pointer, filetype), pointer, 'binary', size)
+        logging.info('{} {}.{} written'.format(self.alias, pointer, filetype))
+
+    def defer(self, url, pointer, function, *args):
+        self.deferred.append((url, pointer, function, args))
+
+    def do_deferred_work(self):
+        # Waits out an open breaker before its host's first deferred item, so that item is
+        # the trial request.  A host that fails again is given up on for the rest of the run.
+        abandoned_hosts = set()
+        while self.deferred:
+            deferred, self.deferred = self.deferred, []
+            for url, pointer, function, args in deferred:
+                host = CdmAPI.host_of(url)
+                if host in abandoned_hosts:
+                    logging.warning('{} {} skipped, {} is still failing'.format(self.alias, pointer, host))
+                    continue
+                CdmAPI.wait_for_circuit(url)
+                try:
+                    function(*args)
+                except urllib.error.URLError as e:
+                    logging.warning('{} {} skipped after deferral: {}'.format(self.alias, pointer, e))
+                    if CdmAPI.circuit_is_open(url):
+                        abandoned_hosts.add(host)
 
     def do_compound_objects(self):
+        # every child of every compound is its own item, so one book's pages and several
+        # books share the same self.workers.
+        self.run_in_order(self.process_compound_item, self.compound_items())
+
+    def compound_items(self):
+        # (parent_pointer, child_pointer) per child; (parent_pointer, None) for a compound
+        # whose children aren't worked on one by one -- pdfpage compounds & empty ones.
         for parent_pointer in self.compound_parents:
             os.makedirs(os.path.join(self.alias_dir, 'Cpd', parent_pointer), exist_ok=True)
+            children_pointers_list = self.read_children_of_cpd(parent_pointer)
+            if not children_pointers_list:
+                yield parent_pointer, None
+                continue
+            child_dir = os.path.realpath(os.path.join(self.alias_dir, 'Cpd', parent_pointer))
+            self.compound_children[parent_pointer] = [child.text for child in children_pointers_list]
+            for child in children_pointers_list:
+                if parent_pointer in self.stale_pointers:
+                    self.forget(child_dir, child.text, self.child_filetype(child_dir, child.text))
+                yield parent_pointer, child.text
+
+    def child_filetype(self, child_dir, child_pointer):
+        # from the child's xml as last harvested; None when there isn't one.
+        try:
+            return parse_binary_original_filetype(child_dir, child_pointer)
+        except (OSError, ET.XMLSyntaxError, AttributeError):
+            return None
+
+    def read_children_of_cpd(self, parent_pointer):
+        # the index file is already on disk; pdfpage children count as none.
+        index_filepath = os.path.join(self.alias_dir, 'Cpd', '{}_cpd.xml'.format(parent_pointer))
+        try:
+            children_pointers_list = ET.parse(index_filepath).findall('.//pageptr')
+        except (OSError, ET.XMLSyntaxError):
+            return []
+        if has_pdfpage_elems(children_pointers_list):
+            return []
+        return children_pointers_list
+
+    def process_compound_item(self, parent_pointer, child_pointer):
+        if child_pointer is not None:
+            child_dir = os.path.realpath(os.path.join(self.alias_dir, 'Cpd', parent_pointer))
+            self.process_child_pointer(child_dir, child_pointer)
+            return
+        try:
             self.write_child_data(parent_pointer)
+        except CdmAPI.CircuitOpen as e:
+            # only the hidden pdf of a pdfpage compound gets this far; children defer themselves.
+            logging.warning('{} {} deferred: {}'.format(self.alias, parent_pointer, e))
+            self.defer(CdmAPI.binary_url(self.alias, parent_pointer), parent_pointer,
+                       self.write_child_data, parent_pointer)
+        except urllib.error.URLError as e:
+            logging.warning('{} {} skipped after retries: {}'.format(self.alias, parent_pointer, e))
 
     def write_child_data(self, parent_pointer):
         children_pointers_list = self.parse_children_of_cpd(parent_pointer)
@@ -226,14 +652,28 @@ class ScrapeAlias():
             logging.warning('{} no children to this compound'.format(parent_pointer))
             return None
         for child in children_pointers_list:
-            child_pointer = child.text
-            self.write_metadata(child_dir, child_pointer, 'simple')
-            try:
-                child_filetype = parse_binary_original_filetype(child_dir, child_pointer)
-            except OSError:
-                logging.warning('{} {} cannot parse original filetype'.format(self.alias, os.path.join(child_dir, child_pointer)))
-                continue
-            self.process_binary(child_dir, child_pointer, child_filetype)
+            self.process_child_pointer(child_dir, child.text)
+
+    def process_child_pointer(self, child_dir, child_pointer):
+        try:
+            self.process_child(child_dir, child_pointer)
+        except CdmAPI.CircuitOpen as e:
+            logging.warning('{} {} deferred: {}'.format(self.alias, child_pointer, e))
+            self.skip_metadata(child_dir, child_pointer, 'simple')
+            self.defer(CdmAPI.item_metadata_url(self.alias, child_pointer, 'xml'), child_pointer,
+                       self.process_child, child_dir, child_pointer)
+        except urllib.error.URLError as e:
+            logging.warning('{} {} skipped after retries: {}'.format(self.alias, child_pointer, e))
+            self.skip_metadata(child_dir, child_pointer, 'simple')
+
+    def process_child(self, child_dir, child_pointer):
+        self.write_metadata(child_dir, child_pointer, 'simple')
+        try:
+            child_filetype = parse_binary_original_filetype(child_dir, child_pointer)
+        except OSError:
+            logging.warning('{} {} cannot parse original filetype'.format(self.alias, os.path.join(child_dir, child_pointer)))
+            return
+        self.process_binary(child_dir, child_pointer, child_filetype)
 
     def parse_children_of_cpd(self, parent_pointer):
         index_filename = '{}_cpd.xml'.format(parent_pointer)
@@ -252,40 +692,72 @@ class ScrapeAlias():
     def try_to_get_a_hidden_pdf_at_root_of_cpd(self, index_filename):
         filepath = os.path.join(self.alias_dir, 'Cpd')
         pointer, filetype = find_cpd_object_original_pointer_filetype(filepath, index_filename)
-        sibling_files = self.find_sibling_files(index_filename)
-        if '{}.{}'.format(pointer, filetype) not in sibling_files:
-            binary = self.try_getting_hidden_pdf(pointer, filetype)
-            if binary:
-                self.write_hidden_pdf_if_a_binary(binary, filepath, pointer, filetype)
-
-    def find_sibling_files(self, filename):
-        return [file
-                for root, dirs, files in self.tree_snapshot
-                for file in files
-                if filename in files]
-
-    def try_getting_hidden_pdf(self, pointer, filetype):
+        sibling_files = self.find_sibling_files()
+        settled = self.known.get((pointer, 'binary')) in cDM_state.SETTLED
+        on_disk = '{}.{}'.format(pointer, filetype) in sibling_files and pointer not in self.stale_pointers
+        if not settled and not on_disk:
+            self.try_getting_hidden_pdf(filepath, pointer, filetype)
+
+    def find_sibling_files(self):
+        # every compound index file lives in the alias' Cpd directory, beside its hidden pdf.
+        return self.files_in(os.path.join(self.alias_dir, 'Cpd'))
+
+    def try_getting_hidden_pdf(self, filepath, pointer, filetype):
+        # streamed to a .part file like any binary.  In some cases contentDM gives an xml
+        # instead of a binary; its opening bytes give it away, and it is discarded.
         try:
-            binary = CdmAPI.retrieve_binary(self.alias, pointer)
-        except urllib.error.HTTPError:
+            size = CdmAPI.download_binary_to_file(self.alias, pointer, filepath, pointer, filetype, reject_xml=True)
+        except urllib.error.HTTPError as e:
             logging.warning('{} {} HTTP error caught on binary'.format(self.alias, pointer))
+            self.record(pointer, 'binary', cDM_state.NOT_FOUND if e.code == 404 else cDM_state.HTTP_ERROR)
             return False
-        return binary
-
-    def write_hidden_pdf_if_a_binary(self, binary, filepath, pointer, filetype):
-        # in some cases, contentDM gives an xml instead of a binary.
-        # it's easier to discern whether something is an xml, than to discern
-        # whether its one of millions of types of valid binaries.
-        # we're going to try to decode the binary or xml into unicode.
-        # if it succeeds, it's an xml & we'll discard it.
-        # if it fails, it's a binary, which we'll write to file.
-        try:
-            binary.decode('utf-8')
+        if size is None:
+            logging.info('{} {} root hidden_pdf is an xml, discarded'.format(filepath, pointer))
             return False
-        except UnicodeDecodeError:
-            CdmAPI.write_binary_to_file(binary, filepath, pointer, filetype)
-            logging.info('{} {} root hidden_pdf written'.format(filepath, pointer))
+        self.written(filepath, '{}.{}'.format(pointer, filetype), pointer, 'binary', size)
+        logging.info('{} {} root hidden_pdf written'.format(filepath, pointer))
+        return True
+
+
+class LogBuffer(logging.Filter):
+    # Attached to the root logger: while a thread is inside capture(), its records are
+    # kept in a buffer instead of reaching the handlers.
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+
+    def filter(self, record):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
             return True
+        buffer.append(record)
+        return False
+
+    def capture(self, function, *args):
+        # returns (records, function's result, exception or None)
+        self.local.buffer = []
+        result, error = None, None
+        try:
+            result = function(*args)
+        except Exception as e:
+            error = e
+        records, self.local.buffer = self.local.buffer, None
+        return records, result, error
+
+
+def replay(captured, lead_records=()):
+    records, result, error = captured
+    for record in list(lead_records) + records:
+        logging.getLogger().handle(record)
+    if error is not None:
+        raise error
+    return result
+
+
+def elems_filename(starting_position, dmrecords=None):
+    if dmrecords:
+        return 'Elems_in_Collection_{}-{}_{}'.format(dmrecords[0], dmrecords[1], starting_position)
+    return 'Elems_in_Collection_{}'.format(starting_position)
 
 
 def find_cpd_object_original_pointer_filetype(filepath, index_filename):
@@ -316,6 +788,63 @@ def is_it_a_404_json(json_text):
     return False
 
 
+def bulk_record_to_item_xml(record_elem, fields):
+    # Lays a dmQuery <record> out the way dmGetItemInfo returns an item.  Returns None
+    # if the record is missing any requested field, since it can't stand in for the
+    # dmGetItemInfo response then.
+    item_elem = ET.Element('xml')
+    for field in fields:
+        field_elem = record_elem.find(field)
+        if field_elem is None:
+            return None
+        ET.SubElement(item_elem, field).text = field_elem.text or ''
+    if not item_elem.findtext('dmrecord') or not item_elem.findtext('find'):
+        return None
+    return '<?xml version="1.0" encoding="UTF-8"?>{}'.format(ET.tostring(item_elem, encoding='unicode'))
+
+
+def bulk_record_to_parent_xml(record_elem):
+    # GetParent's answer for the record's pointer, from its <parentobject>; None without one.
+    parent = (record_elem.findtext('parentobject') or '').strip()
+    if not parent.lstrip('-').isdigit():
+        return None
+    return '<?xml version="1.0" encoding="UTF-8"?><parent>{}</parent>'.format(parent)
+
+
+def xml_to_cdm_json(xml_text):
+    # Rebuilds the json contentDM would have sent for the same request: the root's
+    # children become keys in document order, empty fields become {}, repeated
+    # fields become lists, and the text is escaped the way php's json_encode does it
+    # (ascii-only, slashes escaped, no whitespace).  A bare root such as GetParent's
+    # <parent>-1</parent> becomes {"parent":-1}.
+    xmldata = bytes(bytearray(xml_text, encoding='utf-8'))
+    element_tree = ET.fromstring(xmldata)
+    if len(element_tree):
+        parsed = xml_elem_to_cdm_dict(element_tree)
+    else:
+        text = (element_tree.text or '').strip()
+        parsed = {element_tree.tag: int(text) if text.lstrip('-').isdigit() else text}
+    return json.dumps(parsed, separators=(',', ':'), ensure_ascii=True).replace('/', '\\/')
+
+
+def xml_elem_to_cdm_dict(elem):
+    parsed = dict()
+    for child in elem:
+        if not isinstance(child.tag, str):
+            continue    # comments & processing instructions
+        if len(child):
+            value = xml_elem_to_cdm_dict(child)
+        else:
+            value = child.text if child.text else {}
+        if child.tag in parsed:
+            if not isinstance(parsed[child.tag], list):
+                parsed[child.tag] = [parsed[child.tag]]
+            parsed[child.tag].append(value)
+        else:
+            parsed[child.tag] = value
+    return parsed
+
+
 def has_pdfpage_elems(children_elements_list):
     file_elems = children_elements_list[0].getparent().xpath('./pagefile')
     if file_elems and 'pdfpage' in file_elems[0].text:
@@ -331,11 +860,20 @@ def parse_binary_original_filetype(folder, pointer):
     return filetype
 
 
-def do_collection(alias):
+def do_collection(alias, repo_dir=REPO_DIR, **scrape_options):
     logging.info('starting {}'.format(alias))
-    scrapealias = ScrapeAlias(repo_dir, alias)
-    scrapealias.main()
+    state = open_state(repo_dir)
+    try:
+        ScrapeAlias(repo_dir, alias, state=state, **scrape_options).main()
+    finally:
+        state.close()
     logging.info('finished {}'.format(alias))
+    logging.info(CdmAPI.transfer_report())
+
+
+def open_state(repo_dir):
+    os.makedirs(repo_dir, exist_ok=True)
+    return cDM_state.ScrapeState(os.path.join(repo_dir, cDM_state.STATE_FILENAME))
 
 
 def do_repo_level_objects(repo_dir):
@@ -346,6 +884,71 @@ def do_repo_level_objects(repo_dir):
         logging.info('Collection_List.xml written')
 
 
+def do_all_collections(repo_dir, processes=4, max_in_flight=16, **scrape_options):
+    # Scrapes every alias in Collections_List.xml except WE_DONT_MIGRATE, one alias per
+    # worker process, `processes` at a time.  Together the processes keep at most
+    # max_in_flight requests open against contentDM.  Aliases are handed out largest
+    # first, so the big ones start right away and the small ones fill in around them,
+    # instead of one big alias starting last and running on alone.
+    do_repo_level_objects(repo_dir)
+    aliases = schedule_aliases(repo_dir)
+    request_slots = multiprocessing.BoundedSemaphore(max_in_flight)
+    metrics_queue = multiprocessing.Queue()
+    initargs = (request_slots, CdmAPI.url_prefix, CdmAPI.binary_url_prefix, CdmAPI.cache_dir,
+                metrics_queue, cDM_metrics.EXPORT_INTERVAL)
+    stop_merging = cDM_metrics.start_merging(metrics_queue)
+    failed = []
+    try:
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_collection_worker,
+                                 initargs=initargs) as executor:
+            futures = {executor.submit(do_collection_in_worker, repo_dir, alias, scrape_options): alias
+                       for alias in aliases}
+            for future in as_completed(futures):
+                try:
+                    cDM_metrics.metrics.merge(future.result())
+                except Exception as e:
+                    logging.error('{} failed: {!r}'.format(futures[future], e))
+                    failed.append(futures[future])
+    finally:
+        stop_merging()
+    return failed
+
+
+def schedule_aliases(repo_dir):
+    coll_list_xml = ET.parse(os.path.join(repo_dir, 'Collections_List.xml'))
+    aliases = [alias.text.strip('/') for alias in coll_list_xml.findall('.//alias')
+               if alias.text.strip('/') not in WE_DONT_MIGRATE]
+    sizes = {alias: collection_size(alias) for alias in aliases}
+    return sorted(aliases, key=lambda alias: sizes[alias], reverse=True)
+
+
+def collection_size(alias):
+    try:
+        total_recs_xml = CdmAPI.retrieve_collection_total_recs(alias)
+        return int(ET.fromstring(total_recs_xml.encode('utf-8')).findtext('.//total'))
+    except (urllib.error.URLError, ET.XMLSyntaxError, TypeError, ValueError):
+        return 0
+
+
+def init_collection_worker(request_slots, api_url_prefix, binary_prefix, cache_dir, metrics_queue, metrics_interval):
+    # a spawned (rather than forked) worker starts from a fresh interpreter, so the
+    # settings are passed along explicitly.  Its metrics go to the parent every
+    # metrics_interval, and the rest when each alias is done.
+    if not logging.getLogger().handlers:
+        setup_logging()
+    CdmAPI.configure_servers(api_url_prefix, binary_prefix)
+    CdmAPI.cache_dir = cache_dir
+    CdmAPI.configure_request_slots(request_slots)
+    cDM_metrics.start_forwarding(metrics_queue, metrics_interval)
+
+
+def do_collection_in_worker(repo_dir, alias, scrape_options):
+    # returns the worker's request metrics not yet forwarded, for the parent to merge
+    # into the ones it exports.  An alias that fails leaves its metrics to the forwarder.
+    do_collection(alias, repo_dir, **scrape_options)
+    return cDM_metrics.metrics.drain()
+
+
 def setup_logging():
     logging.basicConfig(filename='scrape_cDM_log.txt',
                         level=logging.INFO,
@@ -360,7 +963,12 @@ def setup_logging():
 
 if __name__ == '__main__':
     setup_logging()
-    repo_dir = os.path.join('..', 'Cached_Cdm_files')
+    repo_dir = REPO_DIR
+    # request latencies, bytes & status codes per endpoint and alias land in
+    # ./cDM_metrics.prom and ./cDM_metrics.json, refreshed every minute.
+    stop_metrics_exporter = cDM_metrics.start_exporter('.')
+    # send a duplicate of any dmGetItemInfo/GetParent call slower than its recent p95.
+    # CdmAPI.hedging = True
 
     """ Get specific collections' metadata/binaries """
 
@@ -369,8 +977,6 @@ if __name__ == '__main__':
 
     """ Get all collections' metadata/binaries """
 
-    # do_repo_level_objects(repo_dir)
-    # coll_list_xml = ET.parse(os.path.join(repo_dir, 'Collections_List.xml'))
-    # for alias in [alias.text.strip('/') for alias in coll_list_xml.findall('.//alias')
-    #               if alias.text.strip('/') not in WE_DONT_MIGRATE]:
-    #     do_collection(alias)
+    # do_all_collections(repo_dir, processes=4, max_in_flight=16)
+
+    stop_metrics_exporter()
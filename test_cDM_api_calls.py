@@ -0,0 +1,455 @@
+#! /usr/bin/python3
+
+import gzip
+import http.server
+import json
+import threading
+import time
+import urllib.error
+
+import pytest
+import cDM_api_calls
+import cDM_async_api_calls
+import cDM_metrics
+
+
+''' Run pytest from project root with: `pytest` '''
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.client_ports.add(self.client_address[1])
+        if self.path.startswith('/moved'):
+            self.send_response(302)
+            self.send_header('Location', '/index.php?q=landed')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if 'dmGetCollectionList' in self.path:
+            self.server.collection_list_hits += 1
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                return
+            body = b'<collections><alias>/imag_alias</alias></collections>'
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path.startswith('/gzipped'):
+            body = ('<xml>' + 'imag ' * 1000 + '</xml>').encode('utf-8')
+            self.send_response(200)
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path.startswith('/chunked'):
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for piece in (b'first ', b'second ', b'third'):
+                self.wfile.write('{:x}\r\n'.format(len(piece)).encode('ascii') + piece + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+            return
+        if self.path.startswith('/getfile'):
+            body = bytes(range(256)) * 40
+            self.send_response(200)
+        elif self.path.startswith('/missing'):
+            body = b'not here'
+            self.send_response(404)
+        else:
+            body = 'you asked for {}'.format(self.path).encode('utf-8')
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def local_server_fixture():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    server.client_ports = set()
+    server.collection_list_hits = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+    cDM_api_calls.configure_connection_pool()
+    cDM_async_api_calls.connection_pool.close_all()
+
+
+def test_pooled_connections_are_reused(local_server_fixture):
+    server, base_url = local_server_fixture
+    cDM_api_calls.configure_connection_pool(pool_size=2, idle_timeout=30)
+    for num in range(5):
+        assert cDM_api_calls.fetch_text('{}/index.php?q={}'.format(base_url, num)) == 'you asked for /index.php?q={}'.format(num)
+    assert len(server.client_ports) == 1
+
+
+def test_idle_connections_expire(local_server_fixture):
+    server, base_url = local_server_fixture
+    cDM_api_calls.configure_connection_pool(pool_size=2, idle_timeout=0)
+    for num in range(3):
+        cDM_api_calls.fetch_text('{}/index.php?q={}'.format(base_url, num))
+    assert len(server.client_ports) == 3
+
+
+def test_open_url_follows_redirects_and_raises_http_errors(local_server_fixture):
+    server, base_url = local_server_fixture
+    assert cDM_api_calls.fetch_text('{}/moved'.format(base_url)) == 'you asked for /index.php?q=landed'
+    with pytest.raises(urllib.error.HTTPError) as excinfo:
+        cDM_api_calls.fetch_text('{}/missing'.format(base_url))
+    assert excinfo.value.code == 404
+    assert cDM_api_calls.fetch_text('{}/index.php?q=after_404'.format(base_url)) == 'you asked for /index.php?q=after_404'
+    assert len(server.client_ports) == 1
+
+
+def test_download_binary_to_file_streams_in_chunks(local_server_fixture, tmp_path, monkeypatch):
+    server, base_url = local_server_fixture
+    monkeypatch.setattr(cDM_api_calls, 'binary_url_prefix', '{}/getfile'.format(base_url))
+    monkeypatch.setattr(cDM_api_calls, 'CHUNK_SIZE', 1000)
+    size = cDM_api_calls.download_binary_to_file('imag_alias', '12', str(tmp_path), '12', 'tif')
+    assert size == 10240
+    assert (tmp_path / '12.tif').read_bytes() == bytes(range(256)) * 40
+    assert not (tmp_path / '12.tif.part').exists()
+
+
+def test_download_binary_to_file_leaves_nothing_on_http_error(local_server_fixture, tmp_path, monkeypatch):
+    server, base_url = local_server_fixture
+    monkeypatch.setattr(cDM_api_calls, 'binary_url_prefix', '{}/missing'.format(base_url))
+    with pytest.raises(urllib.error.HTTPError):
+        cDM_api_calls.download_binary_to_file('imag_alias', '12', str(tmp_path), '12', 'tif')
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_async_fetches_share_the_loop_and_semaphore(local_server_fixture, monkeypatch):
+    server, base_url = local_server_fixture
+    monkeypatch.setattr(cDM_api_calls, 'url_prefix', '{}/index.php?q='.format(base_url))
+    cDM_async_api_calls.set_max_in_flight(4)
+    texts = cDM_async_api_calls.run_all(
+        cDM_async_api_calls.retrieve_item_metadata('imag_alias', pointer, 'xml') for pointer in range(20))
+    assert texts == ['you asked for /index.php?q=dmGetItemInfo/imag_alias/{}/xml'.format(pointer) for pointer in range(20)]
+    assert len(server.client_ports) <= 4
+    assert cDM_async_api_calls.run(cDM_async_api_calls.fetch_text('{}/chunked'.format(base_url))) == 'first second third'
+
+
+def test_async_download_binary_to_file(local_server_fixture, tmp_path, monkeypatch):
+    server, base_url = local_server_fixture
+    monkeypatch.setattr(cDM_api_calls, 'binary_url_prefix', '{}/getfile'.format(base_url))
+    size = cDM_async_api_calls.run(
+        cDM_async_api_calls.download_binary_to_file('imag_alias', '12', str(tmp_path), '12', 'tif'))
+    assert size == 10240
+    assert (tmp_path / '12.tif').read_bytes() == bytes(range(256)) * 40
+    with pytest.raises(urllib.error.HTTPError):
+        cDM_async_api_calls.run(cDM_async_api_calls.fetch_text('{}/missing'.format(base_url)))
+
+
+def test_adaptive_limiter_grows_additively_and_backs_off_multiplicatively(monkeypatch):
+    monkeypatch.setattr(cDM_api_calls, 'DECREASE_COOLDOWN', 0)
+    limiter = cDM_api_calls.AdaptiveLimiter(initial=2, minimum=1, maximum=4)
+    for _ in range(20):
+        acquired = 0
+        while limiter.try_acquire():
+            acquired += 1
+        assert acquired == int(limiter.limit)
+        for _ in range(acquired):
+            limiter.release(0.1)
+    assert limiter.limit == 4
+    limiter.try_acquire()
+    limiter.release(congested=True)
+    assert limiter.limit == 2
+    limiter.try_acquire()
+    limiter.release(5.0)
+    assert limiter.limit == 1
+
+
+def test_adaptive_limiter_is_per_host_and_cut_by_503(local_server_fixture, monkeypatch):
+    server, base_url = local_server_fixture
+    monkeypatch.setattr(cDM_api_calls, 'limiters', dict())
+    monkeypatch.setattr(cDM_api_calls, 'CONGESTION_STATUSES', (404, ))
+    with pytest.raises(urllib.error.HTTPError):
+        cDM_api_calls.fetch_text('{}/missing'.format(base_url))
+    limiter = cDM_api_calls.get_limiter(base_url.split('//')[1])
+    assert limiter.limit == cDM_api_calls.INITIAL_CONCURRENCY * cDM_api_calls.BACKOFF_FACTOR
+    assert limiter.in_flight == 0
+    assert cDM_api_calls.get_limiter('cdm16313.contentdm.oclc.org').limit == cDM_api_calls.INITIAL_CONCURRENCY
+
+
+def test_retry_call_backs_off_and_respects_the_budget(monkeypatch):
+    monkeypatch.setattr(cDM_api_calls, 'RETRY_BASE_DELAY', 0)
+    monkeypatch.setattr(cDM_api_calls, 'retry_budget', cDM_api_calls.RetryBudget(ratio=0, reserve=3))
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ConnectionResetError('imag reset')
+        return 'imag_text'
+    assert cDM_api_calls.retry_call('https://imag/index.php?q=dmGetItemInfo/imag/1/xml', flaky) == 'imag_text'
+    assert len(calls) == 3
+
+    def broken():
+        calls.append(1)
+        raise urllib.error.HTTPError('imag_url', 503, 'imag', {}, None)
+    calls.clear()
+    with pytest.raises(urllib.error.HTTPError):
+        cDM_api_calls.retry_call('https://imag/index.php?q=dmGetItemInfo/imag/1/xml', broken)
+    assert len(calls) == 2    # the budget had one retry left
+
+    def not_found():
+        calls.append(1)
+        raise urllib.error.HTTPError('imag_url', 404, 'imag', {}, None)
+    calls.clear()
+    monkeypatch.setattr(cDM_api_calls, 'retry_budget', cDM_api_calls.RetryBudget(ratio=0, reserve=10))
+    with pytest.raises(urllib.error.HTTPError):
+        cDM_api_calls.retry_call('https://imag/index.php?q=GetParent/imag/1/xml', not_found)
+    assert len(calls) == 1
+
+
+def test_circuit_breaker_opens_per_host(monkeypatch):
+    monkeypatch.setattr(cDM_api_calls, 'RETRY_BASE_DELAY', 0)
+    monkeypatch.setattr(cDM_api_calls, 'CIRCUIT_FAILURE_THRESHOLD', 3)
+    monkeypatch.setattr(cDM_api_calls, 'breakers', dict())
+    monkeypatch.setattr(cDM_api_calls, 'retry_budget', cDM_api_calls.RetryBudget(reserve=100))
+    calls = []
+
+    def broken():
+        calls.append(1)
+        raise ConnectionRefusedError('imag refused')
+    binary_url = 'https://imag_binaries/utils/getfile/collection/imag/id/1/filename/unused.unused'
+    with pytest.raises(urllib.error.URLError):
+        cDM_api_calls.retry_call(binary_url, broken)
+    assert len(calls) == 3
+    with pytest.raises(cDM_api_calls.CircuitOpen):
+        cDM_api_calls.retry_call(binary_url, broken)
+    assert len(calls) == 3
+    assert cDM_api_calls.circuit_is_open(binary_url)
+    # the other host carries on untouched.
+    assert cDM_api_calls.retry_call('https://imag_api/index.php?q=GetParent/imag/1/xml', lambda: 'imag_text') == 'imag_text'
+    breaker = cDM_api_calls.get_breaker('imag_binaries')
+    breaker.opened_at -= cDM_api_calls.CIRCUIT_RESET_TIMEOUT
+    assert breaker.seconds_until_trial() == 0
+    assert cDM_api_calls.retry_call(binary_url, lambda: b'imag_binary') == b'imag_binary'
+    assert not cDM_api_calls.circuit_is_open(binary_url)
+
+
+def test_trial_request_ending_in_any_error_leaves_half_open(monkeypatch):
+    monkeypatch.setattr(cDM_api_calls, 'breakers', dict())
+    binary_url = 'https://imag_binaries/utils/getfile/collection/imag/id/1/filename/unused.unused'
+    breaker = cDM_api_calls.get_breaker('imag_binaries')
+    breaker.state, breaker.opened_at = 'open', time.monotonic() - cDM_api_calls.CIRCUIT_RESET_TIMEOUT
+
+    def no_space_left():
+        raise OSError(28, 'No space left on device')
+    with pytest.raises(OSError):
+        cDM_api_calls.retry_call(binary_url, no_space_left)
+    assert breaker.state != 'half-open'
+    assert cDM_api_calls.retry_call(binary_url, lambda: b'imag_binary') == b'imag_binary'
+
+
+def test_slow_metadata_call_is_hedged(monkeypatch):
+    monkeypatch.setattr(cDM_metrics, 'metrics', cDM_metrics.RequestMetrics())
+    monkeypatch.setattr(cDM_api_calls, 'latency_tracker', cDM_api_calls.LatencyTracker())
+    monkeypatch.setattr(cDM_api_calls, 'hedge_budget', cDM_api_calls.RetryBudget(ratio=0, reserve=1))
+    url = 'https://imag/index.php?q=dmGetItemInfo/imag_alias/1/xml'
+    for _ in range(cDM_api_calls.HEDGE_MIN_SAMPLES):
+        assert cDM_api_calls.hedged_call(url, lambda: 'imag_text') == 'imag_text'
+    calls = []
+
+    def first_one_hangs():
+        calls.append(1)
+        if len(calls) == 1:
+            time.sleep(1)
+            return 'slow_text'
+        return 'fast_text'
+    started = time.monotonic()
+    assert cDM_api_calls.hedged_call(url, first_one_hangs) == 'fast_text'
+    assert time.monotonic() - started < 0.5
+    assert cDM_metrics.metrics.snapshot()[('dmGetItemInfo', 'imag_alias')]['hedges'] == 1
+    # the budget is spent, so the next slow call just waits.
+    calls.clear()
+    assert cDM_api_calls.hedged_call(url, first_one_hangs) == 'slow_text'
+    assert len(calls) == 1
+
+
+def test_endpoint_of():
+    assert cDM_api_calls.endpoint_of(cDM_api_calls.item_metadata_url('imag', '1', 'xml')) == 'dmGetItemInfo'
+    assert cDM_api_calls.endpoint_of(cDM_api_calls.collection_total_recs_url('imag')) == 'dmQueryTotalRecs'
+    assert cDM_api_calls.endpoint_of(cDM_api_calls.binary_url('imag', '1')) == 'getfile'
+
+
+def test_cached_endpoints_are_served_from_disk_then_revalidated(local_server_fixture, tmp_path, monkeypatch):
+    server, base_url = local_server_fixture
+    monkeypatch.setattr(cDM_api_calls, 'url_prefix', '{}/index.php?q='.format(base_url))
+    monkeypatch.setattr(cDM_api_calls, 'cache_dir', str(tmp_path))
+    expected = '<collections><alias>/imag_alias</alias></collections>'
+    assert cDM_api_calls.retrieve_collections_list() == expected
+    assert cDM_api_calls.retrieve_collections_list() == expected
+    assert server.collection_list_hits == 1
+    monkeypatch.setitem(cDM_api_calls.CACHE_TTLS, 'dmGetCollectionList', 0)
+    assert cDM_api_calls.retrieve_collections_list() == expected
+    assert server.collection_list_hits == 2    # answered with a 304
+    monkeypatch.setattr(cDM_api_calls, 'cache_dir', None)
+    assert cDM_api_calls.retrieve_collections_list() == expected
+    assert server.collection_list_hits == 3
+
+
+def test_text_endpoints_are_fetched_compressed(local_server_fixture, monkeypatch):
+    server, base_url = local_server_fixture
+    monkeypatch.setattr(cDM_api_calls, 'transfer_stats', {'wire_bytes': 0, 'decoded_bytes': 0})
+    expected = '<xml>' + 'imag ' * 1000 + '</xml>'
+    assert cDM_api_calls.fetch_text('{}/gzipped'.format(base_url)) == expected
+    assert cDM_async_api_calls.run(cDM_async_api_calls.fetch_text('{}/gzipped'.format(base_url))) == expected
+    assert cDM_api_calls.transfer_stats['decoded_bytes'] == 2 * len(expected)
+    assert cDM_api_calls.transfer_stats['wire_bytes'] < len(expected) / 10
+    assert 'saved by compression' in cDM_api_calls.transfer_report()
+
+
+def test_requests_are_recorded_per_endpoint_and_alias(local_server_fixture, tmp_path, monkeypatch):
+    server, base_url = local_server_fixture
+    monkeypatch.setattr(cDM_metrics, 'metrics', cDM_metrics.RequestMetrics())
+    monkeypatch.setattr(cDM_api_calls, 'url_prefix', '{}/index.php?q='.format(base_url))
+    cDM_api_calls.retrieve_item_metadata('imag_alias', '7', 'xml')
+    cDM_api_calls.retrieve_item_metadata('imag_alias', '8', 'xml')
+    with pytest.raises(urllib.error.HTTPError):
+        cDM_api_calls.fetch_text('{}/missing'.format(base_url))
+    series = cDM_metrics.metrics.snapshot()
+    assert series[('dmGetItemInfo', 'imag_alias')]['count'] == 2
+    assert series[('dmGetItemInfo', 'imag_alias')]['statuses'] == {'200': 2}
+    assert series[('dmGetItemInfo', 'imag_alias')]['bytes'] == 2 * len('you asked for /index.php?q=dmGetItemInfo/imag_alias/7/xml')
+    assert series[('missing', '')]['statuses'] == {'404': 1}
+    stop = cDM_metrics.start_exporter(str(tmp_path), interval=60)
+    stop()
+    prom_text = (tmp_path / 'cDM_metrics.prom').read_text()
+    assert 'cdm_request_duration_seconds_count{endpoint="dmGetItemInfo",alias="imag_alias"} 2' in prom_text
+    assert 'cdm_responses_total{endpoint="missing",alias="",status="404"} 1' in prom_text
+    summary = json.loads((tmp_path / 'cDM_metrics.json').read_text())
+    assert [i['requests'] for i in summary['series'] if i['endpoint'] == 'dmGetItemInfo'] == [2]
+
+
+def test_alias_of():
+    assert cDM_api_calls.alias_of(cDM_api_calls.item_metadata_url('imag', '1', 'xml')) == 'imag'
+    assert cDM_api_calls.alias_of(cDM_api_calls.collection_total_recs_url('imag')) == 'imag'
+    assert cDM_api_calls.alias_of(cDM_api_calls.binary_url('imag', '1')) == 'imag'
+    assert cDM_api_calls.alias_of(cDM_api_calls.collections_list_url()) == ''
+
+
+@pytest.fixture
+def fake_cdm_aliases():
+    # binaries big enough to be cut off halfway, for fake_cdm_fixture in conftest.py.
+    return {'fakecoll1': {'simple': 2, 'binary_size': 30000}}
+
+
+def test_interrupted_download_resumes_with_a_range_request(fake_cdm_fixture, tmp_path, monkeypatch):
+    repository = fake_cdm_fixture.repository
+    expected = repository.binary_for('fakecoll1', repository.items['fakecoll1']['1'])
+    monkeypatch.setitem(repository.config, 'truncate_rate', {'getfile': 1.0})
+    monkeypatch.setitem(cDM_api_calls.RETRY_ATTEMPTS, 'getfile', 1)
+    with pytest.raises(urllib.error.URLError):
+        cDM_api_calls.download_binary_to_file('fakecoll1', '1', str(tmp_path), '1', 'pdf')
+    assert (tmp_path / '1.pdf.part').read_bytes() == expected[:15000]
+    assert not (tmp_path / '1.pdf').exists()
+    monkeypatch.setitem(repository.config, 'truncate_rate', {})
+    assert cDM_api_calls.download_binary_to_file('fakecoll1', '1', str(tmp_path), '1', 'pdf') == 30000
+    assert (tmp_path / '1.pdf').read_bytes() == expected
+    assert repository.request_counts['getfile_range'] == 1
+    assert sorted(i.name for i in tmp_path.iterdir()) == ['1.pdf']
+
+
+def test_whole_part_file_is_finished_without_refetching(fake_cdm_fixture, tmp_path):
+    repository = fake_cdm_fixture.repository
+    expected = repository.binary_for('fakecoll1', repository.items['fakecoll1']['0'])
+    (tmp_path / '0.jp2.part').write_bytes(expected)
+    assert cDM_api_calls.download_binary_to_file('fakecoll1', '0', str(tmp_path), '0', 'jp2') == 30000
+    assert (tmp_path / '0.jp2').read_bytes() == expected
+    assert 'getfile_range' not in repository.request_counts
+
+
+def test_xml_in_place_of_a_binary_is_discarded(fake_cdm_fixture, tmp_path, monkeypatch):
+    monkeypatch.setattr(fake_cdm_fixture.repository, 'binary_for', lambda alias, item: (
+        b'<?xml version="1.0" encoding="utf-8"?><cpd><type>Document-PDF</type></cpd>'))
+    assert cDM_api_calls.download_binary_to_file('fakecoll1', '1', str(tmp_path), '1', 'pdf', reject_xml=True) is None
+    assert list(tmp_path.iterdir()) == []
+    (tmp_path / 'binary').write_bytes(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    assert not cDM_api_calls.starts_like_xml(str(tmp_path / 'binary'))
+
+
+def test_read_timeout_per_endpoint_class(fake_cdm_fixture, monkeypatch):
+    monkeypatch.setitem(fake_cdm_fixture.repository.config, 'latency', {'dmGetItemInfo': 1})
+    monkeypatch.setitem(cDM_api_calls.TIMEOUTS, 'api', {'connect': 1, 'read': 0.2, 'total': None})
+    monkeypatch.setitem(cDM_api_calls.RETRY_ATTEMPTS, 'dmGetItemInfo', 1)
+    started = time.monotonic()
+    with pytest.raises(urllib.error.URLError):
+        cDM_api_calls.retrieve_item_metadata('fakecoll1', '0', 'xml')
+    assert time.monotonic() - started < 1
+    # getfile is in the 'binary' class, so its own deadlines still apply.
+    assert cDM_api_calls.retrieve_binary('fakecoll1', '0')
+
+
+def test_total_deadline_covers_a_trickling_body(fake_cdm_fixture, monkeypatch):
+    monkeypatch.setitem(fake_cdm_fixture.repository.config, 'trickle', {'dmGetItemInfo': 0.1})
+    monkeypatch.setitem(cDM_api_calls.TIMEOUTS, 'api', {'connect': 1, 'read': 1, 'total': 0.3})
+    monkeypatch.setitem(cDM_api_calls.RETRY_ATTEMPTS, 'dmGetItemInfo', 1)
+    started = time.monotonic()
+    # every byte arrives well inside `read`, but the body as a whole takes far longer than `total`.
+    with pytest.raises(urllib.error.URLError):
+        cDM_api_calls.retrieve_item_metadata('fakecoll1', '0', 'xml')
+    assert time.monotonic() - started < 1
+
+
+def test_body_cut_short_by_an_error_releases_the_limiter_as_congested(fake_cdm_fixture, tmp_path, monkeypatch):
+    monkeypatch.setitem(cDM_api_calls.RETRY_ATTEMPTS, 'getfile', 1)
+    releases = []
+    release = cDM_api_calls.AdaptiveLimiter.release
+
+    def record_release(limiter, latency=None, congested=False):
+        releases.append(congested)
+        release(limiter, latency, congested)
+
+    monkeypatch.setattr(cDM_api_calls.AdaptiveLimiter, 'release', record_release)
+    assert cDM_api_calls.download_binary_to_file('fakecoll1', '0', str(tmp_path), '0', 'jp2') == 30000
+    assert releases == [False]
+    monkeypatch.setattr(cDM_api_calls, 'MIN_THROUGHPUT', 10 ** 12)
+    monkeypatch.setattr(cDM_api_calls, 'STALL_WINDOW', 0)
+    with pytest.raises(cDM_api_calls.StalledTransfer):
+        cDM_api_calls.download_binary_to_file('fakecoll1', '1', str(tmp_path), '1', 'pdf')
+    assert releases == [False, True]
+
+
+def test_error_body_that_stalls_gives_back_its_limiter_and_request_slots(fake_cdm_fixture, monkeypatch):
+    monkeypatch.setitem(fake_cdm_fixture.repository.config, 'error_rate', {'dmGetItemInfo': 1.0})
+    monkeypatch.setitem(fake_cdm_fixture.repository.config, 'trickle', {'dmGetItemInfo': 0.5})
+    monkeypatch.setitem(cDM_api_calls.TIMEOUTS, 'api', {'connect': 1, 'read': 0.1, 'total': 5})
+    monkeypatch.setitem(cDM_api_calls.RETRY_ATTEMPTS, 'dmGetItemInfo', 1)
+    slots = threading.BoundedSemaphore(cDM_api_calls.INITIAL_CONCURRENCY)
+    monkeypatch.setattr(cDM_api_calls, 'request_slots', slots)
+    # a 503 whose body stalls past the read timeout; one leak per call would use every slot.
+    for _ in range(cDM_api_calls.INITIAL_CONCURRENCY):
+        with pytest.raises(urllib.error.URLError):
+            cDM_api_calls.retrieve_item_metadata('fakecoll1', '0', 'xml')
+    assert all(limiter.in_flight == 0 for limiter in cDM_api_calls.limiters.values())
+    assert all(slots.acquire(timeout=0) for _ in range(cDM_api_calls.INITIAL_CONCURRENCY))
+
+
+def test_watchdog_cancels_a_stalled_download(fake_cdm_fixture, tmp_path, monkeypatch):
+    monkeypatch.setattr(cDM_api_calls, 'MIN_THROUGHPUT', 10 ** 12)
+    monkeypatch.setattr(cDM_api_calls, 'STALL_WINDOW', 0)
+    monkeypatch.setitem(cDM_api_calls.RETRY_ATTEMPTS, 'getfile', 1)
+    with pytest.raises(cDM_api_calls.StalledTransfer):
+        cDM_api_calls.download_binary_to_file('fakecoll1', '1', str(tmp_path), '1', 'pdf')
+    # the bytes already on disk are kept for the next attempt to resume from.
+    assert (tmp_path / '1.pdf.part').exists()
+    assert not (tmp_path / '1.pdf').exists()
@@ -1,8 +1,12 @@
 #! /usr/bin/python3
 
+import os
+import threading
+import urllib.error
 import pytest
 from mock import patch
 import scrape_cDM
+import cDM_state
 
 
 ''' Run pytest from project root with: `pytest` '''
@@ -16,22 +20,6 @@ def simple_object_etree_fixture():
     return simple_object_etree
 
 
-@pytest.fixture
-def binary_decodes_fixture():
-    class Binary():
-        def decode(self, *args, **kwargs):
-            return True
-    return Binary()
-
-
-@pytest.fixture
-def binary_doesnt_decode_fixture():
-    class Binary():
-        def decode(self, *args, **kwargs):
-            raise UnicodeDecodeError('imag', b"", 42, 43, 'imag_exception occurredd')
-    return Binary()
-
-
 @pytest.fixture
 def ETparse_fixture(*args, **kwargs):
     class ImagParse():
@@ -66,6 +54,297 @@ def total_recs_etree_fixture():
     return coll_total_recs_etree
 
 
+def list_tree(directory):
+    return {os.path.relpath(os.path.join(root, file), directory)
+            for root, dirs, files in os.walk(directory) for file in files}
+
+
+def test_scrape_alias_against_fake_server(fake_cdm_fixture, tmp_path):
+    scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1').main()
+    tree = list_tree(str(tmp_path / 'fakecoll1'))
+    # simple objects 0-5 (4 is missing), compounds 9 & 13 with children 6-8 & 10-12, pdfpage compound 17.
+    for pointer, filetype in (('0', 'jp2'), ('1', 'pdf'), ('2', 'mp4'), ('3', 'tif'), ('5', 'pdf')):
+        for suffix in ('.xml', '.json', '_parent.xml', '_parent.json', '.{}'.format(filetype)):
+            assert '{}{}'.format(pointer, suffix) in tree
+    assert not any(i.startswith('4.') or i.startswith('4_') for i in tree)
+    for parent, children in (('9', ('6', '7', '8')), ('13', ('10', '11', '12'))):
+        assert os.path.join('Cpd', '{}_cpd.xml'.format(parent)) in tree
+        for child in children:
+            assert os.path.join('Cpd', parent, '{}.jp2'.format(child)) in tree
+            assert os.path.join('Cpd', parent, '{}_parent.json'.format(child)) in tree
+    assert os.path.join('Cpd', '17.pdf') in tree
+    assert not any('.part' in i for i in tree)
+    requests_first_run = dict(fake_cdm_fixture.repository.request_counts)
+    scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1').main()
+    assert list_tree(str(tmp_path / 'fakecoll1')) == tree
+    # only the missing pointer's binary is asked for again.
+    assert fake_cdm_fixture.repository.request_counts['getfile'] == requests_first_run['getfile'] + 1
+
+
+def test_state_database_skips_known_404s_on_rerun(fake_cdm_fixture, tmp_path):
+    repository = fake_cdm_fixture.repository
+    state = scrape_cDM.open_state(str(tmp_path))
+    scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', state=state).main()
+    assert state.status('fakecoll1', '4', 'xml') == cDM_state.NOT_FOUND
+    assert state.status('fakecoll1', '4', 'binary') == cDM_state.NOT_FOUND
+    assert state.status('fakecoll1', '0', 'binary') == cDM_state.FETCHED
+    assert state.status('fakecoll1', '17', 'binary') == cDM_state.FETCHED
+    requests_first_run = dict(repository.request_counts)
+    rerun_state = scrape_cDM.open_state(str(tmp_path))
+    scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', state=rerun_state).main()
+    for endpoint in ('dmGetItemInfo', 'GetParent', 'dmGetCompoundObjectInfo', 'getfile'):
+        assert repository.request_counts[endpoint] == requests_first_run[endpoint]
+    state.close()
+    rerun_state.close()
+
+
+def test_listing_pages_are_read_once_for_dmmodified_bulk_and_filetypes(fake_cdm_fixture, tmp_path):
+    state = scrape_cDM.open_state(str(tmp_path))
+    scrapealias = scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', state=state, bulk_metadata=True)
+    scrapealias.do_collection_level_metadata()
+    with patch('scrape_cDM.ET.parse', wraps=scrape_cDM.ET.parse) as mock_parse:
+        scrapealias.do_root_level_objects()
+    assert not [args for args, kwargs in mock_parse.call_args_list if 'Elems_in_Collection' in str(args[0])]
+    scrapealias.record_harvested_dates()
+    assert state.modified_dates('fakecoll1')['0'] == '2017-01-01'
+    assert 'dmGetItemInfo' not in fake_cdm_fixture.repository.request_counts
+    # each record's parentobject stands in for GetParent.
+    assert 'GetParent' not in fake_cdm_fixture.repository.request_counts
+    assert (tmp_path / 'fakecoll1' / '0_parent.xml').read_text() == '<?xml version="1.0" encoding="UTF-8"?><parent>-1</parent>'
+    assert (tmp_path / 'fakecoll1' / '0_parent.json').read_text() == '{"parent":-1}'
+    assert state.status('fakecoll1', '17', 'parent_json') == cDM_state.FETCHED
+    state.close()
+
+
+def test_failed_metadata_is_recorded_in_state(fake_cdm_fixture, tmp_path, monkeypatch):
+    monkeypatch.setitem(fake_cdm_fixture.repository.config, 'error_rate', {'GetParent': 1.0})
+    monkeypatch.setitem(scrape_cDM.CdmAPI.RETRY_ATTEMPTS, 'GetParent', 1)
+    state = scrape_cDM.open_state(str(tmp_path))
+    scrapealias = scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', workers=1, state=state)
+    scrapealias.do_collection_level_metadata()
+    scrapealias.do_root_level_objects()
+    assert state.status('fakecoll1', '0', 'xml') == cDM_state.FETCHED
+    assert state.status('fakecoll1', '0', 'parent_xml') == cDM_state.HTTP_ERROR
+    assert state.status('fakecoll1', '0', 'parent_json') == cDM_state.SKIPPED
+    # a compound's index file comes after its parent info, so it is never asked for.
+    assert state.status('fakecoll1', '17', 'parent_xml') == cDM_state.HTTP_ERROR
+    assert state.status('fakecoll1', '17', 'cpd_xml') == cDM_state.SKIPPED
+    state.close()
+
+
+def test_incremental_rerun_asks_for_a_fresh_total_recs(fake_cdm_fixture, tmp_path, monkeypatch):
+    monkeypatch.setattr(scrape_cDM.CdmAPI, 'cache_dir', str(tmp_path / 'cache'))
+    state = scrape_cDM.open_state(str(tmp_path))
+    for _ in range(2):
+        scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', state=state, incremental=True).do_collection_level_metadata()
+    assert fake_cdm_fixture.repository.request_counts['dmQueryTotalRecs'] == 2
+    # everyone else still takes the cached count.
+    scrape_cDM.CdmAPI.retrieve_collection_total_recs('fakecoll1')
+    assert fake_cdm_fixture.repository.request_counts['dmQueryTotalRecs'] == 2
+    state.close()
+
+
+def test_incremental_rerun_refetches_only_modified_items(fake_cdm_fixture, tmp_path):
+    repository = fake_cdm_fixture.repository
+    state = scrape_cDM.open_state(str(tmp_path))
+    scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', state=state).main()
+    assert state.modified_dates('fakecoll1')['1'] == '2017-01-01'
+    requests_before = dict(repository.request_counts)
+    scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', state=state, incremental=True).main()
+    assert repository.request_counts['dmGetItemInfo'] == requests_before['dmGetItemInfo']
+    assert repository.request_counts['getfile'] == requests_before['getfile']
+    repository.touch('fakecoll1', 1, '2020-02-02')
+    repository.touch('fakecoll1', 9, '2020-02-02')
+    scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', state=state, incremental=True).main()
+    # pointer 1's binary, and those of compound 9's three children.
+    assert repository.request_counts['getfile'] == requests_before['getfile'] + 4
+    assert '2020-02-02' in (tmp_path / 'fakecoll1' / '1.xml').read_text()
+    assert state.modified_dates('fakecoll1')['9'] == '2020-02-02'
+    state.close()
+
+
+def test_incremental_rerun_keeps_the_old_dmmodified_until_the_refetch_succeeds(fake_cdm_fixture, tmp_path, monkeypatch):
+    repository = fake_cdm_fixture.repository
+    state = scrape_cDM.open_state(str(tmp_path))
+    scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', state=state).main()
+    repository.touch('fakecoll1', 1, '2020-02-02')
+    repository.touch('fakecoll1', 9, '2020-02-02')
+    monkeypatch.setitem(repository.config, 'error_rate', {'getfile': 1.0})
+    monkeypatch.setitem(scrape_cDM.CdmAPI.RETRY_ATTEMPTS, 'getfile', 1)
+    scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', state=state, incremental=True).main()
+    assert state.status('fakecoll1', '1', 'binary') == cDM_state.HTTP_ERROR
+    # neither pointer 1's binary nor those of compound 9's children came.
+    assert state.modified_dates('fakecoll1')['1'] == '2017-01-01'
+    assert state.modified_dates('fakecoll1')['9'] == '2017-01-01'
+    requests_before = dict(repository.request_counts)
+    monkeypatch.setitem(repository.config, 'error_rate', {})
+    scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', state=state, incremental=True).main()
+    assert repository.request_counts['getfile'] == requests_before['getfile'] + 4
+    assert state.modified_dates('fakecoll1')['1'] == '2020-02-02'
+    assert state.modified_dates('fakecoll1')['9'] == '2020-02-02'
+    state.close()
+
+
+def test_alias_past_the_dmquery_window_is_listed_in_dmrecord_ranges(fake_cdm_fixture, tmp_path, monkeypatch):
+    repository = fake_cdm_fixture.repository
+    scrapealias = scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1')
+    scrapealias.do_collection_level_metadata()
+    list(scrapealias.listed_root_pointers())
+    assert repository.request_counts['dmQuery'] == 2
+    # the alias has since outgrown the window: 9 root-level records, 5 to a window.
+    repository.config['dmquery_window'] = 5
+    monkeypatch.setattr(scrape_cDM.CdmAPI, 'DMQUERY_WINDOW', 5)
+    list(scrapealias.listed_root_pointers())
+    # ranges 0-4 & 5-9 list 7, 10-14 lists 1 more, 15-19 the last -- each in json & xml.
+    assert repository.request_counts['dmQuery'] == 2 + 8
+    assert os.path.isfile(str(tmp_path / 'fakecoll1' / 'Elems_in_Collection_15-19_1.xml'))
+    # the whole-alias page from before overlaps every range; each pointer is listed once.
+    pointers = [pointer for pointer, filetype in scrapealias.find_root_pointers_filetypes()]
+    assert sorted(pointers, key=int) == ['0', '1', '2', '3', '4', '5', '9', '13', '17']
+
+
+def test_dmquery_ignoring_the_dmrecord_range_is_not_taken_as_a_complete_listing(
+        fake_cdm_fixture, tmp_path, caplog, monkeypatch):
+    repository = fake_cdm_fixture.repository
+    every_root_item = lambda alias, searchstrings: sorted(repository.root_items(alias), key=lambda i: int(i['pointer']))
+    monkeypatch.setattr(fake_cdm_fixture.api_server, 'query_records', every_root_item)
+    monkeypatch.setattr(scrape_cDM.CdmAPI, 'DMQUERY_WINDOW', 5)
+    scrapealias = scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1')
+    scrapealias.chunksize = 2
+    scrapealias.do_collection_level_metadata()
+    with caplog.at_level('WARNING'):
+        pointers = [pointer for pointer, filetype in scrapealias.listed_root_pointers()]
+    # both ranges' first pages claim all 9 records; the ranges aren't paged through.
+    assert pointers == ['0', '1']
+    assert repository.request_counts['dmQuery'] == 2 * 2
+    messages = [record.getMessage() for record in caplog.records]
+    assert 'fakecoll1 dmQuery ignored the dmrecord range 0-4' in messages
+    assert 'fakecoll1 only 2 of 9 root-level records could be listed' in messages
+
+
+def test_listing_pages_are_fetched_together_and_worked_on_as_they_arrive(fake_cdm_fixture, tmp_path, monkeypatch):
+    monkeypatch.setitem(fake_cdm_fixture.repository.config, 'latency', {'dmQuery': 0.05})
+    scrapealias = scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', workers=6)
+    scrapealias.chunksize = 2    # 9 root-level records, 5 pages
+    write_chunk = scrapealias.write_chunk_of_elems_in_collection
+    process_pointer = scrapealias.process_root_level_pointer
+    first_item_started = threading.Event()
+    in_flight, most_in_flight = [0], [0]
+    lock = threading.Lock()
+
+    def write_chunk_of_elems_in_collection(starting_position, chunksize):
+        with lock:
+            in_flight[0] += 1
+            most_in_flight[0] = max(most_in_flight[0], in_flight[0])
+        if starting_position == 9:
+            # the last page waits for item work, which would never start if it waited for the listing.
+            assert first_item_started.wait(5)
+        filename = write_chunk(starting_position, chunksize)
+        with lock:
+            in_flight[0] -= 1
+        return filename
+
+    def process_root_level_pointer(pointer, filetype):
+        first_item_started.set()
+        process_pointer(pointer, filetype)
+
+    monkeypatch.setattr(scrapealias, 'write_chunk_of_elems_in_collection', write_chunk_of_elems_in_collection)
+    monkeypatch.setattr(scrapealias, 'process_root_level_pointer', process_root_level_pointer)
+    scrapealias.main()
+    assert most_in_flight[0] > 1
+    assert scrapealias.compound_parents == ['9', '13', '17']
+    assert (tmp_path / 'fakecoll1' / 'Cpd' / '17.pdf').exists()
+
+
+def test_find_root_pointers_filetypes_streams_each_record_once(tmp_path):
+    alias_dir = tmp_path / 'imag_alias'
+    alias_dir.mkdir()
+    record = '<record><filetype>{}</filetype><dmrecord>{}</dmrecord></record>'
+    (alias_dir / 'Elems_in_Collection_1.xml').write_text(
+        '<results><pager><total>3</total></pager><records>{}{}{}</records></results>'.format(
+            record.format('JP2', 1), record.format('cpd', 5), record.format('pdf', 2)))
+    (alias_dir / 'Elems_in_Collection_0-4_1.xml').write_text(
+        '<results><records>{}{}</records></results>'.format(record.format('jp2', 1), record.format('mp4', 3)))
+    scrapealias = scrape_cDM.ScrapeAlias(str(tmp_path), 'imag_alias')
+    files = ['Elems_in_Collection_1.xml', 'Elems_in_Collection_0-4_1.xml']
+    pointers_filetypes = scrapealias.find_root_pointers_filetypes(files)
+    assert next(pointers_filetypes) == ('1', 'jp2')
+    assert list(pointers_filetypes) == [('5', 'cpd'), ('2', 'pdf'), ('3', 'mp4')]
+
+
+def test_getfile_outage_defers_binaries_and_spares_metadata(fake_cdm_fixture, tmp_path, monkeypatch):
+    repository = fake_cdm_fixture.repository
+    monkeypatch.setitem(repository.config, 'error_rate', {'getfile': 1.0})
+    monkeypatch.setattr(scrape_cDM.CdmAPI, 'RETRY_BASE_DELAY', 0)
+    monkeypatch.setattr(scrape_cDM.CdmAPI, 'breakers', dict())
+
+    def skip_the_wait(url):
+        breaker = scrape_cDM.CdmAPI.get_breaker(scrape_cDM.CdmAPI.host_of(url))
+        if breaker.opened_at is not None:
+            breaker.opened_at -= breaker.reset_timeout
+    monkeypatch.setattr(scrape_cDM.CdmAPI, 'wait_for_circuit', skip_the_wait)
+    scrape_cDM.ScrapeAlias(str(tmp_path), 'fakecoll1', workers=1).main()
+    tree = list_tree(str(tmp_path / 'fakecoll1'))
+    for pointer in ('0', '1', '2', '3', '5'):
+        assert '{}.json'.format(pointer) in tree
+    for child in ('6', '7', '8', '10', '11', '12'):
+        assert os.path.join('Cpd', '9' if int(child) < 9 else '13', '{}_parent.json'.format(child)) in tree
+    assert not any(i.endswith(('.jp2', '.pdf', '.mp4', '.tif')) for i in tree)
+    # the breaker opened after CIRCUIT_FAILURE_THRESHOLD failures, plus one trial at the end.
+    assert repository.request_counts['getfile'] <= scrape_cDM.CdmAPI.CIRCUIT_FAILURE_THRESHOLD + 1
+
+
+@pytest.mark.parametrize('chunksize', [1024, 3])
+def test_root_level_workers_keep_log_and_compound_order(fake_cdm_fixture, tmp_path, caplog, monkeypatch, chunksize):
+    monkeypatch.setitem(fake_cdm_fixture.repository.config, 'latency', {'dmGetItemInfo': 0.01, 'getfile': 0.02})
+    monkeypatch.setattr(scrape_cDM.ScrapeAlias, 'chunksize', chunksize)
+    runs = []
+    for workers in (1, 6):
+        caplog.clear()
+        with caplog.at_level('INFO'):
+            scrapealias = scrape_cDM.ScrapeAlias(str(tmp_path / str(workers)), 'fakecoll1', workers=workers)
+            scrapealias.main()
+        messages = [record.getMessage().replace(str(tmp_path / str(workers)), '') for record in caplog.records]
+        runs.append((messages, scrapealias.compound_parents))
+    assert runs[0] == runs[1]
+    assert runs[0][1] == ['9', '13', '17']
+
+
+def test_compound_items_spread_children_across_workers(tmp_path):
+    cpd_dir = tmp_path / 'imag_alias' / 'Cpd'
+    cpd_dir.mkdir(parents=True)
+    (cpd_dir / '3_cpd.xml').write_text('<cpd><page><pageptr>1</pageptr></page><page><pageptr>2</pageptr></page></cpd>')
+    (cpd_dir / '5_cpd.xml').write_text('<cpd><page><pagefile>5.pdfpage</pagefile><pageptr>4</pageptr></page></cpd>')
+    scrapealias = scrape_cDM.ScrapeAlias(str(tmp_path), 'imag_alias')
+    scrapealias.compound_parents = ['3', '5', '7']
+    assert list(scrapealias.compound_items()) == [('3', '1'), ('3', '2'), ('5', None), ('7', None)]
+    assert (cpd_dir / '7').is_dir()
+
+
+@pytest.mark.parametrize('fake_cdm_aliases', [{
+    'small': {'simple': 2, 'binary_size': 100},
+    'large': {'simple': 6, 'compound': 1, 'children': 2, 'binary_size': 100},
+    'medium': {'simple': 4, 'binary_size': 100},
+    'skipped': {'simple': 1, 'binary_size': 100}}])
+def test_all_collections_run_in_worker_processes(fake_cdm_fixture, tmp_path, monkeypatch):
+    monkeypatch.setattr(scrape_cDM, 'WE_DONT_MIGRATE', {'skipped'})
+    monkeypatch.setattr(scrape_cDM.cDM_metrics, 'metrics', scrape_cDM.cDM_metrics.RequestMetrics())
+    # the workers forward their metrics mid-alias too.
+    monkeypatch.setattr(scrape_cDM.cDM_metrics, 'EXPORT_INTERVAL', 0.01)
+    scrape_cDM.do_repo_level_objects(str(tmp_path))
+    assert scrape_cDM.schedule_aliases(str(tmp_path)) == ['large', 'medium', 'small']
+    assert scrape_cDM.do_all_collections(str(tmp_path), processes=2, max_in_flight=3) == []
+    assert '1.pdf' in os.listdir(str(tmp_path / 'small'))
+    assert os.path.join('Cpd', '8', '6.jp2') in list_tree(str(tmp_path / 'large'))
+    assert '3.tif' in os.listdir(str(tmp_path / 'medium'))
+    assert not (tmp_path / 'skipped').exists()
+    # the workers' requests are in the parent's metrics, each counted once.
+    series = scrape_cDM.cDM_metrics.metrics.snapshot()
+    assert series[('getfile', 'medium')]['count'] == 4
+    # twice to schedule the aliases (above, and in do_all_collections), once in the worker.
+    assert series[('dmQueryTotalRecs', 'medium')]['count'] == 3
+
+
 def test_is_it_a_404_xml():
     error_return_text = """<?xml version="1.0" encoding="UTF-8"?><error><code>-2</code><message>Requested item not found</message><restrictionCode>-1</restrictionCode></error>"""
     assert scrape_cDM.is_it_a_404_xml(error_return_text) is True
@@ -76,6 +355,96 @@ def test_is_it_a_404_json():
     assert scrape_cDM.is_it_a_404_json(error_return_text) is True
 
 
+def test_xml_to_cdm_json():
+    error_xml = """<?xml version="1.0" encoding="UTF-8"?><error><code>-2</code><message>Requested item not found</message><restrictionCode>-1</restrictionCode></error>"""
+    assert scrape_cDM.xml_to_cdm_json(error_xml) == """{"code":"-2","message":"Requested item not found","restrictionCode":"-1"}"""
+    item_xml = """<?xml version="1.0" encoding="UTF-8"?><xml><title>Vieux Carr\u00e9</title><contri></contri><relati>http://louisdl.louislibraries.org/cdm4</relati><find>1.jp2</find></xml>"""
+    assert scrape_cDM.xml_to_cdm_json(item_xml) == """{"title":"Vieux Carr\\u00e9","contri":{},"relati":"http:\\/\\/louisdl.louislibraries.org\\/cdm4","find":"1.jp2"}"""
+    assert scrape_cDM.xml_to_cdm_json("""<?xml version="1.0" encoding="UTF-8"?><parent>-1</parent>""") == '{"parent":-1}'
+
+
+@patch('scrape_cDM.CdmAPI')
+def test_write_metadata_fetch_once(mock_API):
+    mock_API.retrieve_item_metadata.return_value = '<xml><title>Some Title</title><contri></contri></xml>'
+    mock_API.retrieve_parent_info.return_value = '<parent>-1</parent>'
+    scrapealias = scrape_cDM.ScrapeAlias('_', 'imag_alias', fetch_once=True)
+    scrapealias.write_metadata('imag_dir', 'imag_pointer', 'simple')
+    mock_API.retrieve_item_metadata.assert_called_once_with('imag_alias', 'imag_pointer', 'xml')
+    mock_API.retrieve_parent_info.assert_called_once_with('imag_alias', 'imag_pointer', 'xml')
+    mock_API.write_json_to_file.assert_any_call('{"title":"Some Title","contri":{}}', 'imag_dir', 'imag_pointer')
+    mock_API.write_json_to_file.assert_any_call('{"parent":-1}', 'imag_dir', 'imag_pointer_parent')
+
+
+@patch('scrape_cDM.CdmAPI')
+def test_write_metadata_fetch_once_after_a_known_404(mock_API, tmp_path):
+    mock_API.retrieve_parent_info.return_value = '<parent>-1</parent>'
+    scrapealias = scrape_cDM.ScrapeAlias(str(tmp_path), 'imag_alias', fetch_once=True)
+    scrapealias.known = {('4', 'xml'): cDM_state.NOT_FOUND, ('4', 'parent_xml'): cDM_state.NOT_FOUND}
+    scrapealias.write_metadata(str(tmp_path), '4', 'simple')
+    # neither xml is on disk to convert; both json twins are 404s like them, without asking.
+    assert scrapealias.known[('4', 'json')] == cDM_state.NOT_FOUND
+    assert scrapealias.known[('4', 'parent_json')] == cDM_state.NOT_FOUND
+    mock_API.retrieve_item_metadata.assert_not_called()
+    mock_API.retrieve_parent_info.assert_not_called()
+
+
+def test_forget_discards_only_the_pointers_own_files(tmp_path):
+    scrapealias = scrape_cDM.ScrapeAlias(str(tmp_path), 'imag_alias')
+    scrapealias.file_index = {'dir': {'1.xml', '1.json', '1_parent.xml', '1_parent.json', '1.jp2', '1.tif',
+                                      '10.xml', '10.jp2', '2.xml'}}
+    scrapealias.known = {('1', 'xml'): cDM_state.FETCHED, ('2', 'xml'): cDM_state.FETCHED}
+    scrapealias.forget('dir', '1', 'jp2')
+    assert scrapealias.file_index['dir'] == {'1.tif', '10.xml', '10.jp2', '2.xml'}
+    assert scrapealias.known == {('2', 'xml'): cDM_state.FETCHED}
+
+
+@patch('scrape_cDM.CdmAPI')
+def test_file_index_skips_existing_files_and_records_new_ones(mock_API):
+    mock_API.retrieve_parent_info.side_effect = lambda alias, pointer, xml_or_json: {
+        'xml': '<parent>-1</parent>', 'json': '{"parent":-1}'}[xml_or_json]
+    scrapealias = scrape_cDM.ScrapeAlias('_', 'imag_alias')
+    scrapealias.file_index = {'imag_dir': {'imag_pointer.xml', 'imag_pointer.json'}}
+    scrapealias.write_metadata('imag_dir', 'imag_pointer', 'simple')
+    assert not mock_API.retrieve_item_metadata.called
+    assert mock_API.retrieve_parent_info.call_count == 2
+    assert scrapealias.files_in('imag_dir') == {'imag_pointer.xml', 'imag_pointer.json',
+                                                'imag_pointer_parent.xml', 'imag_pointer_parent.json'}
+    scrapealias.process_binary('imag_dir', 'imag_pointer', 'jp2')
+    scrapealias.process_binary('imag_dir', 'imag_pointer', 'jp2')
+    assert mock_API.download_binary_to_file.call_count == 1
+
+
+@patch('scrape_cDM.CdmAPI')
+def test_stalled_binary_is_deferred_to_the_end(mock_API):
+    mock_API.download_binary_to_file.side_effect = [urllib.error.URLError('stalled'), 4096]
+    scrapealias = scrape_cDM.ScrapeAlias('_', 'imag_alias')
+    scrapealias.process_binary('imag_dir', 'imag_pointer', 'jp2')
+    assert [(pointer, args) for url, pointer, function, args in scrapealias.deferred] == [
+        ('imag_pointer', ('imag_dir', 'imag_pointer', 'jp2'))]
+    scrapealias.do_deferred_work()
+    assert scrapealias.deferred == []
+    assert mock_API.download_binary_to_file.call_count == 2
+
+
+def test_bulk_records_are_written_as_they_are_listed(tmp_path):
+    alias_dir = tmp_path / 'imag_alias'
+    alias_dir.mkdir()
+    (alias_dir / 'Collection_Fields.xml').write_text("""<?xml version="1.0" encoding="UTF-8"?><fields><field><name>Title</name><nick>title</nick></field><field><name>Contributor</name><nick>contri</nick></field></fields>""")
+    (alias_dir / 'Elems_in_Collection_1.xml').write_text("""<?xml version="1.0" encoding="UTF-8"?><results><records>
+        <record><collection>/imag_alias</collection><pointer>7</pointer><filetype>jp2</filetype><parentobject>-1</parentobject><title>Seven</title><contri></contri><fullrs></fullrs><find>8.jp2</find><dmaccess></dmaccess><dmimage></dmimage><dmcreated>2017-01-01</dmcreated><dmmodified>2017-01-02</dmmodified><dmoclcno></dmoclcno><dmrecord>7</dmrecord></record>
+        <record><collection>/imag_alias</collection><pointer>9</pointer><filetype>cpd</filetype><parentobject>-1</parentobject><title>Nine</title><contri></contri><fullrs></fullrs><find>10.cpd</find><dmaccess></dmaccess><dmimage></dmimage><dmcreated>2017-01-01</dmcreated><dmmodified>2017-01-02</dmmodified><dmoclcno></dmoclcno><dmrecord>9</dmrecord></record>
+        <record><collection>/imag_alias</collection><pointer>11</pointer><filetype>jp2</filetype><parentobject>-1</parentobject><title>No contri</title><find>12.jp2</find><dmrecord>11</dmrecord></record>
+        </records></results>""")
+    scrapealias = scrape_cDM.ScrapeAlias(str(tmp_path), 'imag_alias', bulk_metadata=True)
+    scrapealias.elems_in_collection_pages = lambda: iter(['Elems_in_Collection_1'])
+    assert list(scrapealias.listed_root_pointers()) == [('7', 'jp2'), ('9', 'cpd'), ('11', 'jp2')]
+    assert (alias_dir / '7.xml').read_text() == '<?xml version="1.0" encoding="UTF-8"?><xml><title>Seven</title><contri></contri><fullrs></fullrs><find>8.jp2</find><dmaccess></dmaccess><dmimage></dmimage><dmcreated>2017-01-01</dmcreated><dmmodified>2017-01-02</dmmodified><dmoclcno></dmoclcno><dmrecord>7</dmrecord></xml>'
+    assert (alias_dir / '7.json').read_text().startswith('{"title":"Seven","contri":{},"fullrs":{},"find":"8.jp2"')
+    assert (alias_dir / 'Cpd' / '9.xml').exists()
+    assert not (alias_dir / '11.xml').exists()
+    assert (alias_dir / '11_parent.xml').exists()
+
+
 def test_has_pdfpage_elems(indexfile_etree_fixture):
     assert scrape_cDM.has_pdfpage_elems(indexfile_etree_fixture) is True
 
@@ -116,64 +485,43 @@ def test_cpd_object_original_pointer_filetype(mock_ET, cpd_object_etree_fixture)
     mock_ET.parse.assert_called_with('imag_filepath/imagpointer.xml')
 
 
-@patch('scrape_cDM.CdmAPI.write_binary_to_file')
-def test_write_hidden_pdf_if_a_binary__xml_received_instead_of_binary_failure(mock_API, binary_decodes_fixture):
-    # binary = """<?xml version="1.0" encoding="utf-8"?><cpd><type>Document-PDF</type><page><pagetitle>Page 1</pagetitle><pagefile>3605.pdfpage</pagefile><pageptr>3604</pageptr></page></cpd>""".encode('utf-8')
-    filepath, pointer, filetype = 'imag_filepath', 'imag_pointer', 'imag_filetype'
-    scrapealias = scrape_cDM.ScrapeAlias('_', '_')
-    assert scrapealias.write_hidden_pdf_if_a_binary(binary_decodes_fixture, filepath, pointer, filetype) is False
-
-
-@patch('scrape_cDM.CdmAPI.write_binary_to_file')
-def test_write_hidden_pdf_if_a_binary__xml_received_instead_of_binary_success(mock_API, binary_doesnt_decode_fixture):
-    # binary = """<?xml version="1.0" encoding="utf-8"?><cpd><type>Document-PDF</type><page><pagetitle>Page 1</pagetitle><pagefile>3605.pdfpage</pagefile><pageptr>3604</pageptr></page></cpd>""".encode('utf-8')
-    filepath, pointer, filetype = 'imag_filepath', 'imag_pointer', 'imag_filetype'
-    scrapealias = scrape_cDM.ScrapeAlias('_', '_')
-    assert scrapealias.write_hidden_pdf_if_a_binary(binary_doesnt_decode_fixture, filepath, pointer, filetype) is True
-    mock_API.assert_called_with(binary_doesnt_decode_fixture, 'imag_filepath', 'imag_pointer', 'imag_filetype')
-
-
 def test_find_sibling_files():
-    scrapealias = scrape_cDM.ScrapeAlias('_', '_')
-    scrapealias.tree_snapshot = [['imag_a', ['imagd_1'], ['a1', 'a2', 'a3']], [['imag_b'], [], ['b1', 'b2']], [['imag_c'], [], ['c1', 'c2', 'c3', 'c4']]]
-    assert set(scrapealias.find_sibling_files('a1')) == {'a1', 'a2', 'a3'}
-    assert set(scrapealias.find_sibling_files('b2')) == {'b1', 'b2'}
-    assert set(scrapealias.find_sibling_files('c3')) == {'c1', 'c2', 'c3', 'c4'}
+    scrapealias = scrape_cDM.ScrapeAlias('imag_repo', 'imag_alias')
+    cpd_dir = os.path.join(scrapealias.alias_dir, 'Cpd')
+    scrapealias.file_index = {scrapealias.alias_dir: {'1.xml', '2_cpd.xml'},
+                              cpd_dir: {'2_cpd.xml', '2.xml', '3.pdf'},
+                              os.path.join(cpd_dir, '2'): {'2_cpd.xml', '4.xml'}}
+    assert set(scrapealias.find_sibling_files()) == {'2_cpd.xml', '2.xml', '3.pdf'}
+    assert set(scrape_cDM.ScrapeAlias('imag_repo', 'other_alias').find_sibling_files()) == set()
 
 
-@patch('scrape_cDM.ScrapeAlias.write_hidden_pdf_if_a_binary')
 @patch('scrape_cDM.ScrapeAlias.try_getting_hidden_pdf')
 @patch('scrape_cDM.ScrapeAlias.find_sibling_files')
 @patch('scrape_cDM.find_cpd_object_original_pointer_filetype')
-def test_try_to_get_a_hidden_pdf_at_root_of_cpd(mock_findcpd, mock_findsibl, mock_tryhidden, mock_writehidden):
+def test_try_to_get_a_hidden_pdf_at_root_of_cpd(mock_findcpd, mock_findsibl, mock_tryhidden):
     # if binary already on disk.
     scrapealias = scrape_cDM.ScrapeAlias('_', '_')
     scrapealias.alias_dir = 'fake/filepath'
     scrapealias.find_sibling_files = mock_findsibl
     scrapealias.try_getting_hidden_pdf = mock_tryhidden
-    scrapealias.write_hidden_pdf_if_a_binary = mock_writehidden
     mock_findcpd.return_value = ('imag1', 'img')
     mock_findsibl.return_value = ['imag1.img', 'imag2.img', 'imag3.img']
     scrapealias.try_to_get_a_hidden_pdf_at_root_of_cpd('fakefile')
     mock_findcpd.assert_called_with('fake/filepath/Cpd', 'fakefile')
-    mock_findsibl.assert_called_with('fakefile')
+    mock_findsibl.assert_called_with()
     assert not mock_tryhidden.called
-    assert not mock_writehidden.called
 
     # if binary not already on disk
     scrapealias = scrape_cDM.ScrapeAlias('_', '_')
     scrapealias.alias_dir = 'fake/filepath'
     scrapealias.find_sibling_files = mock_findsibl
     scrapealias.try_getting_hidden_pdf = mock_tryhidden
-    scrapealias.write_hidden_pdf_if_a_binary = mock_writehidden
     mock_findcpd.return_value = ('imag1', 'other')
     mock_findsibl.return_value = ['imag1.img', 'imag2.img', 'imag3.img']
-    mock_tryhidden.return_value = 'imag_binary'
     scrapealias.try_to_get_a_hidden_pdf_at_root_of_cpd('fakefile')
     mock_findcpd.assert_called_with('fake/filepath/Cpd', 'fakefile')
-    mock_findsibl.assert_called_with('fakefile')
-    mock_tryhidden.assert_called_with('imag1', 'other')
-    mock_writehidden.assert_called_with('imag_binary', 'fake/filepath/Cpd', 'imag1', 'other')
+    mock_findsibl.assert_called_with()
+    mock_tryhidden.assert_called_with('fake/filepath/Cpd', 'imag1', 'other')
 
 
 @patch('scrape_cDM.ScrapeAlias.do_collection_level_metadata')
@@ -213,7 +561,7 @@ def test_do_collection_level_metadata(mock_API, mock_os):
 
     mock_os.listdir.return_value = ('')
     scrapealias.do_collection_level_metadata()
-    mock_API.retrieve_collection_total_recs.assert_called_with('imag_alias')
+    mock_API.retrieve_collection_total_recs.assert_called_with('imag_alias', fresh=False)
     mock_API.retrieve_collection_metadata.assert_called_with('imag_alias')
     mock_API.retrieve_collection_fields_json.assert_called_with('imag_alias')
     mock_API.retrieve_collection_fields_xml.assert_called_with('imag_alias')
@@ -230,10 +578,17 @@ def test_do_collection_level_metadata(mock_API, mock_os):
 def test_try_getting_hidden_pdf(mock_API):
     scrapealias = scrape_cDM.ScrapeAlias('imag_path', 'imag_alias')
     import urllib
-    mock_API.retrieve_binary.return_value = 'actual_imag_binary'
-    assert scrapealias.try_getting_hidden_pdf('imag_pointer', 'imag_filetype') == 'actual_imag_binary'
-    mock_API.retrieve_binary.side_effect = urllib.error.HTTPError('imag', b"", 42, 43, 'imag_exception occurredd')
-    assert scrapealias.try_getting_hidden_pdf('imag_pointer', 'imag_filetype') is False
+    mock_API.download_binary_to_file.return_value = 3000
+    assert scrapealias.try_getting_hidden_pdf('imag_dir', 'imag_pointer', 'imag_filetype') is True
+    mock_API.download_binary_to_file.assert_called_with('imag_alias', 'imag_pointer', 'imag_dir', 'imag_pointer',
+                                                        'imag_filetype', reject_xml=True)
+    assert 'imag_pointer.imag_filetype' in scrapealias.files_in('imag_dir')
+    # an xml instead of a binary
+    mock_API.download_binary_to_file.return_value = None
+    assert scrapealias.try_getting_hidden_pdf('imag_dir', 'other_pointer', 'imag_filetype') is False
+    assert 'other_pointer.imag_filetype' not in scrapealias.files_in('imag_dir')
+    mock_API.download_binary_to_file.side_effect = urllib.error.HTTPError('imag', b"", 42, 43, 'imag_exception occurredd')
+    assert scrapealias.try_getting_hidden_pdf('imag_dir', 'imag_pointer', 'imag_filetype') is False
 
 
 @patch('scrape_cDM.has_pdfpage_elems')